@@ -6,8 +6,8 @@ python -m venv ./build/venv
 source ./build/venv/bin/activate
 
 pip install --upgrade pip
-pip install pyinstaller requests psutil
-CMAKE_ARGS="-DGGML_VULKAN=on" pip install llama-cpp-python
+pip install pyinstaller requests
+CMAKE_ARGS="-DGGML_VULKAN=on" pip install llama-cpp-python==0.3.16
 
 cp ./src/*.py -t build/
 cd build
@@ -19,9 +19,11 @@ pyinstaller --onefile --collect-all llama-cpp-python \
     --hidden-import vkllama_run \
     --hidden-import vkllama_serve \
     --hidden-import vkllama_list \
+    --hidden-import vkllama_backend \
     --add-data="vkllama_run.py:." \
     --add-data="vkllama_list.py:." \
     --add-data="vkllama_serve.py:." \
+    --add-data="vkllama_backend.py:." \
     --add-binary="./venv/lib/python3.13/site-packages/llama_cpp/lib/libllama.so:llama_cpp/lib" \
     vkllama.py
 
@@ -4,6 +4,7 @@ import argparse
 import vkllama_run
 import vkllama_list
 import vkllama_serve
+import vkllama_backend
 
 
 # main
@@ -33,6 +34,27 @@ if __name__ == '__main__':
     serve_parser.add_argument('--host', default='0.0.0.0', type=str, help='Server host address')
     serve_parser.add_argument('-m', '--models', default=vkllama_serve.DEFAULT_MODELS_PATH, type=str, help='LLM models path')
     serve_parser.add_argument('-p', '--port', default=11435, type=int, help='Server port')
+    serve_parser.add_argument('--parallel', default=1, type=int, help='Number of generations running on the device at the same time')
+    serve_parser.add_argument('--max-loaded', default=1, type=int, help='Number of model instances kept loaded between requests')
+    serve_parser.add_argument('--sessions', default=vkllama_serve.DEFAULT_SESSIONS_PATH, type=str, help='Chat session snapshots path')
+    serve_parser.add_argument('--sessions-compression', default='zlib', type=str, choices=vkllama_serve.SESSION_COMPRESSIONS, help='Chat session snapshots compression')
+    serve_parser.add_argument('--trace-file', default=None, type=str, help='Write sampled request traces to this file')
+    serve_parser.add_argument('--trace-sample', default=1.0, type=float, help='Share of requests to trace (0.0 - 1.0)')
+    serve_parser.add_argument('--trace-format', default='chrome', type=str, choices=vkllama_serve.TRACE_FORMATS, help='Trace file format: Chrome trace JSON or OTLP-JSON')
+    serve_parser.add_argument('--access-log', default=None, type=str, help='Write a JSON-lines access log to this file')
+    serve_parser.add_argument('--error-log', default=None, type=str, help='Write errors with stack traces to this file instead of stderr')
+    serve_parser.add_argument('--log-max-bytes', default=64 * 1024 * 1024, type=int, help='Rotate log files at this size')
+    serve_parser.add_argument('--log-backups', default=5, type=int, help='Number of rotated log files to keep')
+    serve_parser.add_argument('--preload', nargs='+', default=None, type=str, help='Load models before accepting requests: name or name@num_ctx')
+    serve_parser.add_argument('--reuse-port', action='store_true', help='Bind with SO_REUSEPORT, so a new instance can take over while this one drains')
+    serve_parser.add_argument('--drain-timeout', default=vkllama_serve.DEFAULT_DRAIN_TIMEOUT, type=float, help='Seconds to wait for in-flight requests on SIGTERM')
+    serve_parser.add_argument('--backend', default=vkllama_backend.DEFAULT_BACKEND, type=str, choices=vkllama_backend.BACKENDS, help='Inference backend, "stub" generates deterministic tokens without models for load tests')
+    serve_parser.add_argument('--stub-rate', default=vkllama_backend.DEFAULT_STUB_RATE, type=float, help='Stub backend decode speed (tokens/s)')
+    serve_parser.add_argument('--stub-prompt-rate', default=vkllama_backend.DEFAULT_STUB_PROMPT_RATE, type=float, help='Stub backend prompt evaluation speed (tokens/s)')
+    serve_parser.add_argument('--stub-tokens', default=vkllama_backend.DEFAULT_STUB_TOKENS, type=int, help='Stub backend answer length (tokens)')
+    serve_parser.add_argument('--stub-load-time', default=vkllama_backend.DEFAULT_STUB_LOAD_TIME, type=float, help='Stub backend model load time (s)')
+    serve_parser.add_argument('--limit-rps', default=0, type=float, help='Requests per second per client and model, 0 - unlimited')
+    serve_parser.add_argument('--limit-tpm', default=0, type=int, help='Prompt and generated tokens per minute per client and model, 0 - unlimited')
     # serve_parser.add_argument('-d', '--device', default=imagine_server_defs.DEFAULT_DEVICE, type=str,  choices=['cpu', 'cuda', 'mps'], help='Model compute device')
     serve_parser.add_argument('--help', action='help')
 
@@ -0,0 +1,508 @@
+import re
+import time
+import ctypes
+import zlib
+import random
+import numpy as np
+
+
+BACKENDS = ('llama.cpp', 'stub')
+DEFAULT_BACKEND = 'llama.cpp'
+
+# stub: decode and prompt evaluation speed (tokens/s), answer length, load time (s)
+DEFAULT_STUB_RATE = 50.0
+DEFAULT_STUB_PROMPT_RATE = 1000.0
+DEFAULT_STUB_TOKENS = 128
+DEFAULT_STUB_LOAD_TIME = 0.0
+STUB_EMBEDDING_SIZE = 384
+
+STUB_SPECIAL = ['<s>', '</s>', '<think>', '</think>', '\n', '\n\n']
+STUB_WORDS = [
+    ' lorem', ' ipsum', ' dolor', ' sit', ' amet', ' consectetur', ' adipiscing', ' elit',
+    ' sed', ' do', ' eiusmod', ' tempor', ' incididunt', ' ut', ' labore', ' et',
+    ' dolore', ' magna', ' aliqua', ' enim', ' ad', ' minim', ' veniam', ' quis',
+    ' nostrud', ' exercitation', ' ullamco', ' laboris', ' nisi', ' aliquip', ' ex', ' ea',
+    ' commodo', ' consequat', ' duis', ' aute', ' irure', ' in', ' reprehenderit', ' voluptate',
+    ' velit', ' esse', ' cillum', ' fugiat', ' nulla', ' pariatur', ' excepteur', ' sint',
+    ' occaecat', ' cupidatat', ' non', ' proident', ' sunt', ' culpa', ' qui', ' officia',
+    ' deserunt', ' mollit', ' anim', ' id', ' est', ' laborum', '.', ','
+]
+STUB_VOCAB = STUB_SPECIAL + STUB_WORDS
+STUB_TOKEN_PATTERN = re.compile(r'<think>|</think>|\n\n|\n| ?[^\s<]+|<|\s')
+
+
+class LogitsProcessorList(list):
+    # same as llama_cpp.LogitsProcessorList, the server doesn't import the runtime
+    def __call__(self, input_ids, scores):
+        for processor in self:
+            scores = processor(input_ids, scores)
+        return scores
+
+
+class State:
+    # Copy of the kv cache and the tokens in it, like llama_cpp.LlamaState without the
+    # logits of every position: `scores` has the last row only (none for an empty context)
+    def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed, sampler=None):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+        self.sampler = sampler
+
+
+class Backend:
+    # Runtime behind the server. Loaded models only need the public llama_cpp.Llama completion
+    # interface (n_ctx, create_chat_completion / create_completion with logits processors,
+    # create_embedding), everything about the kv cache and the runtime state goes through the backend.
+    name = None
+
+    def load(self, model_path, model_info, n_ctx, seed, embedding=False):
+        raise NotImplementedError
+
+    def unload(self, llm):
+        pass
+
+    def compile_grammar(self, gbnf=None, schema=None):
+        # gbnf text or a JSON schema string, the result is passed to completions as `grammar`
+        raise NotImplementedError
+
+    def tokenize(self, llm, text, special=False):
+        return llm.tokenize(text.encode('utf-8'), add_bos=False, special=special)
+
+    def detokenize(self, llm, tokens, prev_tokens=None):
+        # bytes, `prev_tokens` for the leading space handling of some tokenizers
+        return llm.detokenize(tokens, prev_tokens=prev_tokens, special=True)
+
+    def get_n_tokens(self, llm):
+        # number of tokens in the kv cache
+        raise NotImplementedError
+
+    def get_tokens(self, llm):
+        # token ids in the kv cache
+        raise NotImplementedError
+
+    def reset(self, llm):
+        # forget the kv cache
+        raise NotImplementedError
+
+    def evaluate(self, llm, tokens):
+        # append tokens to the kv cache
+        raise NotImplementedError
+
+    def shift_context(self, llm, n_keep, n_discard):
+        # drop n_discard tokens after the first n_keep from the kv cache and move the rest back,
+        # False when the runtime can't, the kv cache is empty then
+        raise NotImplementedError
+
+    def save_state(self, llm):
+        # copy of the kv cache and everything needed to go on generating
+        raise NotImplementedError
+
+    def load_state(self, llm, state):
+        raise NotImplementedError
+
+    def get_state_tokens(self, state):
+        return state.input_ids[:state.n_tokens].tolist()
+
+    def dump_state(self, state):
+        # (json fields, bytes) for a snapshot file
+        input_ids = np.asarray(state.input_ids[:state.n_tokens], dtype=np.int32).tobytes()
+        scores = np.asarray(state.scores[-1:], dtype=np.float32)
+        llama_state = bytes(state.llama_state)[:state.llama_state_size]
+
+        fields = {
+            'n_tokens': state.n_tokens,
+            'n_vocab': scores.shape[1] if scores.ndim == 2 else 0,
+            'n_scores': scores.shape[0] if scores.ndim == 2 else 0,
+            'seed': state.seed,
+            'llama_state_size': state.llama_state_size
+        }
+        return fields, input_ids + scores.tobytes() + llama_state
+
+    def restore_state(self, fields, payload):
+        # reverse of dump_state
+        n_tokens = fields['n_tokens']
+        scores_size = fields['n_scores'] * fields['n_vocab'] * 4
+
+        input_ids = np.frombuffer(payload[:n_tokens * 4], dtype=np.int32).astype(np.intc)
+        scores = np.frombuffer(payload[n_tokens * 4:n_tokens * 4 + scores_size], dtype=np.single)
+        scores = scores.reshape(fields['n_scores'], fields['n_vocab']).copy()
+
+        return State(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=payload[n_tokens * 4 + scores_size:],
+            llama_state_size=fields['llama_state_size'],
+            seed=fields['seed']
+        )
+
+    def chat_complete(self, llm, messages, max_tokens, stream, **params):
+        return llm.create_chat_completion(messages=messages, max_tokens=max_tokens, stream=stream, **params)
+
+    def complete(self, llm, prompt, max_tokens, stream, **params):
+        # prompt is text or token ids
+        return llm.create_completion(prompt=prompt, max_tokens=max_tokens, stream=stream, **params)
+
+    def embed(self, llm, inputs):
+        return llm.create_embedding(inputs)
+
+    def load_adapter(self, llm, path):
+        raise NotImplementedError
+
+    def set_adapters(self, llm, adapters):
+        # [(adapter, scale)], replaces the adapters applied to the context
+        raise NotImplementedError
+
+
+class LlamaCppBackend(Backend):
+    name = 'llama.cpp'
+
+    def load(self, model_path, model_info, n_ctx, seed, embedding=False):
+        import llama_cpp
+
+        return llama_cpp.Llama(
+            model_path=model_path,
+            n_gpu_layers=-1,
+            n_ctx=n_ctx,
+            seed=seed,
+            embedding=embedding,
+            verbose=False
+        )
+
+    def unload(self, llm):
+        # frees the context and the weights now instead of on garbage collection
+        close = getattr(llm, 'close', None)
+        if close:
+            close()
+
+    def compile_grammar(self, gbnf=None, schema=None):
+        import llama_cpp
+
+        if schema is not None:
+            return llama_cpp.LlamaGrammar.from_json_schema(schema, verbose=False)
+        return llama_cpp.LlamaGrammar.from_string(gbnf or llama_cpp.llama_grammar.JSON_GBNF, verbose=False)
+
+    def get_n_tokens(self, llm):
+        return llm.n_tokens
+
+    def get_tokens(self, llm):
+        return llm._input_ids.tolist()
+
+    def reset(self, llm):
+        llm.reset()
+
+    def evaluate(self, llm, tokens):
+        llm.eval(tokens)
+
+    def shift_context(self, llm, n_keep, n_discard):
+        n_past = llm.n_tokens
+        try:
+            llm._ctx.kv_cache_seq_rm(0, n_keep, n_keep + n_discard)
+            llm._ctx.kv_cache_seq_shift(0, n_keep + n_discard, n_past, -n_discard)
+        except AttributeError:
+            # no kv shift in this llama-cpp-python
+            llm.n_tokens = 0
+            return False
+
+        # llama.cpp now matches the whole kept window as a cached prefix
+        llm.input_ids[n_keep:n_past - n_discard] = llm.input_ids[n_keep + n_discard:n_past].copy()
+        llm.n_tokens = n_past - n_discard
+        return True
+
+    def save_state(self, llm):
+        # Llama.save_state copies the logits of all n_ctx positions (n_ctx * n_vocab floats),
+        # the llama.cpp state has the kv cache and the logits of the last token already.
+        # The sampler of a running generation lives on the Llama object, a generation that
+        # is paused and resumed on this llm needs its own one back.
+        import llama_cpp
+
+        ctx = llm._ctx.ctx
+        size = llama_cpp.llama_state_get_size(ctx)
+        llama_state = (ctypes.c_uint8 * size)()
+        llama_state_size = llama_cpp.llama_state_get_data(ctx, llama_state, size)
+
+        n_tokens = llm.n_tokens
+        return State(
+            input_ids=llm.input_ids[:n_tokens].copy(),
+            scores=llm.scores[max(n_tokens - 1, 0):n_tokens].copy(),
+            n_tokens=n_tokens,
+            llama_state=llama_state,
+            llama_state_size=llama_state_size,
+            seed=llm._seed,
+            sampler=getattr(llm, '_sampler', None)
+        )
+
+    def load_state(self, llm, state):
+        import llama_cpp
+
+        llama_state = state.llama_state
+        if not isinstance(llama_state, ctypes.Array):
+            llama_state = (ctypes.c_uint8 * state.llama_state_size).from_buffer_copy(llama_state)
+        if llama_cpp.llama_state_set_data(llm._ctx.ctx, llama_state, state.llama_state_size) != state.llama_state_size:
+            raise RuntimeError('Failed to set llama state data')
+
+        n_tokens = state.n_tokens
+        llm.input_ids[:n_tokens] = state.input_ids[:n_tokens]
+        # python side copy of the last logits, llama-cpp-python samples from it
+        llm.scores[n_tokens - len(state.scores):n_tokens] = state.scores
+        llm.n_tokens = n_tokens
+        llm._seed = state.seed
+        if state.sampler is not None:
+            llm._sampler = state.sampler
+
+    def load_adapter(self, llm, path):
+        # LoRA adapters belong to the model and are freed with it
+        import llama_cpp
+
+        init = getattr(llama_cpp, 'llama_adapter_lora_init', None) or llama_cpp.llama_lora_adapter_init
+        adapter = init(llm.model, path.encode('utf-8'))
+        if not adapter:
+            raise RuntimeError(f'Failed to load LoRA adapter {path}')
+        return adapter
+
+    def set_adapters(self, llm, adapters):
+        import llama_cpp
+
+        clear = getattr(llama_cpp, 'llama_clear_adapter_lora', None) or llama_cpp.llama_lora_adapter_clear
+        apply = getattr(llama_cpp, 'llama_set_adapter_lora', None) or llama_cpp.llama_lora_adapter_set
+
+        clear(llm.ctx)
+        for adapter, scale in adapters:
+            if apply(llm.ctx, adapter, scale) != 0:
+                raise RuntimeError('Failed to apply LoRA adapter')
+
+
+class StubLlama:
+    # Deterministic fake model: answers are drawn from a fixed vocabulary by the request seed,
+    # prompt evaluation and decoding take time according to the backend rates. Logits processors
+    # are called for every token like in llama.cpp, forced tokens (-inf scores elsewhere) are honored.
+    def __init__(self, backend, model_info, n_ctx, seed, embedding):
+        self.backend = backend
+        self.thinking = model_info.get('thinking', False)
+        self._n_ctx = n_ctx
+        self.seed = seed
+        self.embedding = embedding
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.adapters = []
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return len(STUB_VOCAB)
+
+    def token_bos(self):
+        return 0
+
+    def token_eos(self):
+        return 1
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [self.token_bos()] if add_bos else []
+        for piece in STUB_TOKEN_PATTERN.findall(text.decode('utf-8', errors='ignore')):
+            if piece in STUB_VOCAB:
+                tokens.append(STUB_VOCAB.index(piece))
+            else:
+                tokens.append(len(STUB_SPECIAL) + zlib.crc32(piece.encode('utf-8')) % len(STUB_WORDS))
+        return tokens
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return ''.join(STUB_VOCAB[t] for t in tokens if t > 1).encode('utf-8')
+
+    def _evaluate(self, tokens):
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f'Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}')
+
+        time.sleep(len(tokens) / self.backend.prompt_rate)
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+
+    def _answer(self, seed, length):
+        rng = random.Random(seed)
+        words = [len(STUB_SPECIAL) + rng.randrange(len(STUB_WORDS)) for _ in range(length)]
+        if self.thinking:
+            n_think = length // 4
+            words = [2] + words[:n_think] + [3, 5] + words[n_think:]
+        return words + [self.token_eos()]
+
+    def _generate(self, prompt, max_tokens, logits_processor, seed):
+        # yields (token, finish_reason), the sampled token is evaluated before the next one like in llama.cpp
+        prompt = list(prompt)
+
+        # reuse the common prefix
+        n_past = 0
+        while n_past < min(self.n_tokens, len(prompt) - 1) and self.input_ids[n_past] == prompt[n_past]:
+            n_past += 1
+        self.n_tokens = n_past
+        self._evaluate(prompt[n_past:])
+
+        # llama.cpp stops at the end of the context with 'length', the last token is not evaluated
+        if max_tokens is None or max_tokens <= 0 or self.n_tokens + max_tokens > self._n_ctx:
+            max_tokens = self._n_ctx - self.n_tokens
+        # adapters change the answer like they would change the weights
+        seed = self.seed if seed is None else seed
+        answer = self._answer(seed + zlib.crc32(repr(self.adapters).encode('utf-8')), self.backend.tokens)
+
+        interval = 1.0 / self.backend.rate
+        deadline = time.perf_counter()
+        position = 0
+        closed = False
+        # the sampled token, evaluated at the next step
+        token = None
+        for index in range(max_tokens):
+            if index > 0:
+                # decode the previous token, paced to the configured rate (no catching up after a pause)
+                deadline = max(deadline + interval, time.perf_counter())
+                time.sleep(max(0.0, deadline - time.perf_counter()))
+                self.input_ids[self.n_tokens] = token
+                self.n_tokens += 1
+                closed = closed or token == 3
+
+            # a think block closed by forced tokens is not opened or closed again
+            if closed and answer[position] == 2:
+                position = answer.index(3) + 2
+            elif closed and answer[position] == 3:
+                position += 2
+
+            token = answer[position]
+            if logits_processor:
+                scores = np.zeros(len(STUB_VOCAB), dtype=np.float32)
+                scores = logits_processor(self.input_ids[:self.n_tokens], scores)
+                if np.isneginf(scores).any():
+                    token = int(np.argmax(scores))
+
+            if token == answer[position]:
+                position = min(position + 1, len(answer) - 1)
+
+            if token == self.token_eos():
+                yield None, 'stop'
+                return
+            yield token, None
+
+        yield None, 'length'
+
+    def _stream(self, prompt, max_tokens, logits_processor, seed, chat):
+        # like llama.cpp the role chunk comes with the first token, after the prompt is evaluated
+        for index, (token, finish_reason) in enumerate(self._generate(prompt, max_tokens, logits_processor, seed)):
+            if chat and index == 0:
+                yield {'choices': [{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]}
+
+            piece = STUB_VOCAB[token] if token is not None else ''
+            if chat:
+                delta = {'content': piece} if piece else {}
+                yield {'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            else:
+                yield {'choices': [{'index': 0, 'text': piece, 'finish_reason': finish_reason}]}
+
+    def _complete(self, prompt, max_tokens, logits_processor, seed, chat):
+        n_prompt = len(prompt)
+        text = ''
+        completion_tokens = 0
+        finish_reason = 'stop'
+
+        for token, finish_reason in self._generate(prompt, max_tokens, logits_processor, seed):
+            if token is not None:
+                text += STUB_VOCAB[token]
+                completion_tokens += 1
+
+        choice = {'index': 0, 'finish_reason': finish_reason}
+        if chat:
+            choice['message'] = {'role': 'assistant', 'content': text}
+        else:
+            choice['text'] = text
+
+        return {
+            'choices': [choice],
+            'usage': {'prompt_tokens': n_prompt, 'completion_tokens': completion_tokens, 'total_tokens': n_prompt + completion_tokens}
+        }
+
+    def create_chat_completion(self, messages, max_tokens=None, stream=False, logits_processor=None, seed=None, **params):
+        # grammar, sampling and stop parameters are accepted and ignored
+        text = ''.join(f'<|{m["role"]}|>\n{m.get("content") or ""}\n' for m in messages) + '<|assistant|>\n'
+        prompt = self.tokenize(text.encode('utf-8'))
+        if stream:
+            return self._stream(prompt, max_tokens, logits_processor, seed, chat=True)
+        return self._complete(prompt, max_tokens, logits_processor, seed, chat=True)
+
+    def create_completion(self, prompt, max_tokens=16, stream=False, logits_processor=None, seed=None, **params):
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt.encode('utf-8'))
+        if stream:
+            return self._stream(prompt, max_tokens, logits_processor, seed, chat=False)
+        return self._complete(prompt, max_tokens, logits_processor, seed, chat=False)
+
+    def create_embedding(self, input):
+        if not self.embedding:
+            raise RuntimeError('Llama model must be created with embedding=True to call this method')
+
+        inputs = [input] if isinstance(input, str) else input
+        data = []
+        n_tokens = 0
+        for index, text in enumerate(inputs):
+            tokens = self.tokenize(text.encode('utf-8'))
+            n_tokens += len(tokens)
+            time.sleep(len(tokens) / self.backend.prompt_rate)
+
+            rng = np.random.default_rng(zlib.crc32(text.encode('utf-8')))
+            embedding = rng.standard_normal(STUB_EMBEDDING_SIZE).astype(np.float32)
+            embedding /= np.linalg.norm(embedding)
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding.tolist()})
+
+        return {'object': 'list', 'data': data, 'usage': {'prompt_tokens': n_tokens, 'total_tokens': n_tokens}}
+
+
+class StubBackend(Backend):
+    # For load tests and profiling of the serving layer without models or a GPU,
+    # model files don't have to exist (models.json does)
+    name = 'stub'
+
+    def __init__(self, rate=DEFAULT_STUB_RATE, prompt_rate=DEFAULT_STUB_PROMPT_RATE, tokens=DEFAULT_STUB_TOKENS, load_time=DEFAULT_STUB_LOAD_TIME):
+        self.rate = rate
+        self.prompt_rate = prompt_rate
+        self.tokens = tokens
+        self.load_time = load_time
+
+    def load(self, model_path, model_info, n_ctx, seed, embedding=False):
+        time.sleep(self.load_time)
+        return StubLlama(self, model_info, n_ctx, seed, embedding)
+
+    def compile_grammar(self, gbnf=None, schema=None):
+        # ignored by the stub
+        return schema or gbnf or 'json'
+
+    def get_n_tokens(self, llm):
+        return llm.n_tokens
+
+    def get_tokens(self, llm):
+        return llm.input_ids[:llm.n_tokens].tolist()
+
+    def reset(self, llm):
+        llm.n_tokens = 0
+
+    def evaluate(self, llm, tokens):
+        llm._evaluate(list(tokens))
+
+    def shift_context(self, llm, n_keep, n_discard):
+        n_past = llm.n_tokens
+        llm.input_ids[n_keep:n_past - n_discard] = llm.input_ids[n_keep + n_discard:n_past].copy()
+        llm.n_tokens = n_past - n_discard
+        return True
+
+    def save_state(self, llm):
+        n_tokens = llm.n_tokens
+        scores = np.zeros((min(n_tokens, 1), len(STUB_VOCAB)), dtype=np.float32)
+        return State(llm.input_ids[:n_tokens].copy(), scores, n_tokens, b'', 0, llm.seed)
+
+    def load_state(self, llm, state):
+        llm.input_ids[:state.n_tokens] = state.input_ids[:state.n_tokens]
+        llm.n_tokens = state.n_tokens
+
+    def load_adapter(self, llm, path):
+        return path
+
+    def set_adapters(self, llm, adapters):
+        llm.adapters = list(adapters)
@@ -1,4 +1,5 @@
 import json
+import uuid
 import requests
 import datetime
 
@@ -6,6 +7,7 @@ import datetime
 DEFAULT_MODEL = 'gemma3n'
 VKLLAMA_GENERATE_URL = 'http://{address}/api/generate'
 VKLLAMA_CHAT_URL = 'http://{address}/api/chat'
+VKLLAMA_SESSION_URL = 'http://{address}/api/session'
 
 COMMANDS = [
     {
@@ -34,11 +36,11 @@ COMMANDS = [
     },
     {
         'cmd': '/save',
-        'help': 'save chat to file (leave empty for automatic filename)'
+        'help': 'save chat and model state snapshot to file (leave empty for automatic filename)'
     },
     {
         'cmd': '/load',
-        'help': 'load chat from json file'
+        'help': 'load chat and model state snapshot from json file'
     },
     {
         'cmd': '/chat',
@@ -63,11 +65,29 @@ COMMANDS = [
 ]
 
 
-def chat(model, system, address, seed):
+def session_request(address, session, action, model, ctx):
+    payload = {
+        'session': session,
+        'action': action,
+        'model': model,
+        'options': {
+            'num_ctx': ctx
+        }
+    }
+
+    response = requests.post(VKLLAMA_SESSION_URL.format(address=address), json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def chat(model, system, address, seed, think):
     messages = []
     ctx = 4096
     limit = 4096
 
+    # server keeps the kv cache of the session, so /save and /load don't recompute the chat
+    session = uuid.uuid4().hex
+
     if system:
         messages.append({'role': 'system', 'content': system})
 
@@ -142,8 +162,14 @@ def chat(model, system, address, seed):
             filename = f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json' if len(parts) == 1 else parts[1].strip()
 
             with open(filename, 'w') as f:
-                json.dump(messages, f, indent=2, ensure_ascii=False)
+                json.dump({'session': session, 'messages': messages}, f, indent=2, ensure_ascii=False)
                 print(f'Chat saved: "{filename}".')
+
+            try:
+                snapshot = session_request(address, session, 'save', model, ctx)
+                print(f'Snapshot saved: {snapshot["n_tokens"]} tokens.')
+            except Exception as e:
+                print(f'Snapshot is not saved: {e}')
             continue
         elif prompt.startswith('/load'):
             parts = prompt.split(' ')
@@ -155,10 +181,24 @@ def chat(model, system, address, seed):
 
             try:
                 with open(filename, 'r') as f:
-                    messages = json.load(f)
+                    chat_data = json.load(f)
+
+                    # plain list of messages in older files
+                    if isinstance(chat_data, dict):
+                        messages = chat_data['messages']
+                        session = chat_data.get('session') or uuid.uuid4().hex
+                    else:
+                        messages = chat_data
+                        session = uuid.uuid4().hex
 
                     print(f'Chat loaded: "{filename}".')
 
+                    try:
+                        snapshot = session_request(address, session, 'load', model, ctx)
+                        print(f'Snapshot loaded: {snapshot["n_tokens"]} tokens.')
+                    except Exception:
+                        pass # no snapshot, the chat is evaluated on the next answer
+
                     for msg in messages:
                         if msg['role'] == 'user':
                             print(f'> {msg["content"].strip()}')
@@ -241,10 +281,14 @@ def chat(model, system, address, seed):
             'model': model,
             'seed': seed,
             'stream': True,
+            'think': think,
+            'session': session,
             'messages': messages,
             'options': {
                 'num_ctx': ctx,
-                'num_predict': limit
+                'num_predict': limit,
+                'priority': 'high', # interactive
+                'context_strategy': 'shift'
             }
         }
 
@@ -272,11 +316,12 @@ def chat(model, system, address, seed):
             messages[1]['content'] += answer.strip()
 
 
-def generate(prompt, system, model, address, seed, stream):
+def generate(prompt, system, model, address, seed, stream, think):
     payload = {
         'model': model,
         'seed': seed,
         'stream': stream,
+        'think': think,
         'prompt': prompt.strip()
     }
 
@@ -301,6 +346,6 @@ def run(args):
     prompt = ' '.join(args.prompt)
 
     if prompt:
-        generate(prompt, args.sys, args.model, args.address, args.seed, args.stream)
+        generate(prompt, args.sys, args.model, args.address, args.seed, args.stream, args.think)
     else:
-        chat(args.model, args.sys, args.address, args.seed)
+        chat(args.model, args.sys, args.address, args.seed, args.think)
@@ -1,29 +1,133 @@
 import os
+import re
+import sys
 import json
-import psutil
+import zlib
+import base64
+import lzma
+import queue
+import uuid
 import random
+import time
+import signal
+import socket
 import hashlib
+import ipaddress
 import datetime
-import llama_cpp
+import threading
+import collections
+import logging
+import logging.handlers
+import vkllama_backend
+import numpy as np
 import http.server
+import urllib.parse
 import socketserver
 
 
 DEFAULT_MODEL = 'gemma3'
 DEFAULT_MODELS_PATH = '~/.vkllama/models'
+DEFAULT_SESSIONS_PATH = '~/.vkllama/sessions'
+DEFAULT_NUM_CTX = 4096
+DEFAULT_DRAIN_TIMEOUT = 60.0
+MAX_CANDIDATES = 16
+GRAMMAR_CACHE_SIZE = 32 # converted grammars, llama-cpp-python 0.3 parses them per request
+METRICS_WINDOW = 1024
+
+# rank: who preempts whom, weight: share of decoded tokens, slo_ttft: time to first token target (s)
+PRIORITY_CLASSES = {
+    'high': {'rank': 2, 'weight': 8, 'slo_ttft': 2.0},
+    'normal': {'rank': 1, 'weight': 4, 'slo_ttft': 10.0},
+    'low': {'rank': 0, 'weight': 1, 'slo_ttft': 120.0}
+}
+DEFAULT_PRIORITY = 'normal'
+
+CONTEXT_STRATEGIES = ('truncate', 'shift', 'none')
+DEFAULT_CONTEXT_STRATEGY = 'truncate'
+THINK_PROMPT_TAIL = 32 # prompt tokens searched for a think block opened by the chat template
+MESSAGE_TOKEN_OVERHEAD = 8 # chat template tokens around each message (approx.)
+TRUNCATE_STEP = 0.5 # truncation drops whole blocks of turns of about half the prompt budget
+SHIFT_MAX_TOKENS_FACTOR = 10 # unlimited num_predict with context shift stops at 10 * num_ctx
+
+SESSION_MAGIC = b'VKLLAMA-SESSION-1\n'
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+SESSION_CACHE_SIZE = 256 # sessions with known kv cache tokens
+SESSION_STATES_SIZE = 2 # loaded snapshots waiting for their next request
+SESSION_COMPRESSIONS = ('none', 'zlib', 'lzma')
+
+TRACE_FORMATS = ('chrome', 'otlp')
+MAX_PROFILE_SECONDS = 10
+
+RATE_LIMIT_CLIENTS = 4096 # idle clients are forgotten above this
+RATE_LIMIT_IDLE = 600.0
+RATE_LIMIT_CHARS_PER_TOKEN = 4 # request body size to a prompt token estimate
+
+ERROR_LOG_RATE = 10 # errors with stack traces per period, the rest is only counted
+ERROR_LOG_PERIOD = 60.0
 
 models_path = DEFAULT_MODELS_PATH
+models_config = None # models.json, read again when the file changes and on SIGHUP
+models_stamp = None
+models_lock = threading.Lock()
+backend = vkllama_backend.LlamaCppBackend()
 
+# grammars by format hash (lru), with llama-cpp-python 0.3 a grammar only holds the gbnf
+# text, so one instance is safely shared by concurrent requests
+grammar_cache = collections.OrderedDict()
+grammar_cache_lock = threading.Lock()
+grammar_cache_stats = {'hits': 0, 'misses': 0}
 
-def get_models():
+
+def read_models():
     expanded_models_path = os.path.expanduser(models_path)
     os.makedirs(expanded_models_path, exist_ok=True)
 
     # read models
     with open(f'{expanded_models_path}/models.json', 'r') as f:
-        models_config = json.load(f)
-        return models_config
-    return None
+        return json.load(f)
+
+
+def get_models_stamp():
+    # a stat per request instead of parsing the file
+    stat = os.stat(os.path.join(os.path.expanduser(models_path), 'models.json'))
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_models():
+    stamp = get_models_stamp()
+    if models_config is None or stamp != models_stamp:
+        with models_lock:
+            if models_config is None or stamp != models_stamp:
+                update_models(stamp)
+    return models_config
+
+
+def update_models(stamp):
+    # a broken models.json keeps the current config
+    global models_config, models_stamp
+    models_stamp = stamp
+    try:
+        config = read_models()
+    except Exception as e:
+        if models_config is None:
+            raise
+        error_logger.error(f'Failed to reload models.json, keeping the current models: {e}')
+        return
+
+    reloaded = models_config is not None
+    models_config = config
+    model_pool.retire(config)
+    if reloaded:
+        print(f'Reloaded models.json: {len(config)} models.')
+
+
+def reload_models():
+    # SIGHUP, also when the file time didn't change
+    with models_lock:
+        try:
+            update_models(get_models_stamp())
+        except Exception as e:
+            error_logger.error(f'Failed to reload models.json: {e}')
 
 
 def calculate_file_sha256(filepath):
@@ -46,22 +150,1564 @@ def fix_model_name(model_name):
     return ':'.join(parts)
 
 
-def get_memory_usage():
-    process = psutil.Process(os.getpid())
-    info = process.memory_info()
-    # print(info)
-    total_memory = info.vms + info.shared + info.data
-    return total_memory / 1024 / 1024
+def load_model(model_info, n_ctx, seed, embedding=False):
+    expanded_models_path = os.path.expanduser(models_path)
+    model_path = os.path.join(expanded_models_path, model_info['filename'])
+
+    return backend.load(model_path, model_info, n_ctx, seed, embedding)
+
+
+def get_sampling_params(options):
+    return {
+        'max_tokens': options.get('num_predict', 4096),
+        'temperature': options.get('temperature', 0.8),
+        'top_p': options.get('top_p', 0.9),
+        'top_k': options.get('top_k', 40),
+        'frequency_penalty': options.get('frequency_penalty', 0.0),
+        'presence_penalty': options.get('presence_penalty', 0.0)
+    }
+
+
+def get_num_candidates(request_payload, options):
+    # best-of-n: `n` in request or `num_candidates` in options, returns (field, value) unchecked
+    if options.get('num_candidates') is not None:
+        return 'num_candidates', options['num_candidates']
+    if request_payload.get('n') is not None:
+        return 'n', request_payload['n']
+    return 'n', 1
+
+
+def get_candidate_seed(seed, index):
+    return (seed + index) % 2**32
+
+
+def get_grammar(response_format):
+    # https://github.com/ollama/ollama/blob/main/docs/api.md#request-structured-outputs
+    if not response_format:
+        return None, {}
+
+    if response_format == 'json':
+        key = 'json'
+    elif isinstance(response_format, dict):
+        schema = json.dumps(response_format, sort_keys=True)
+        key = hashlib.sha256(schema.encode('utf-8')).hexdigest()
+    else:
+        raise ValueError('must be "json" or a JSON schema object')
+
+    with grammar_cache_lock:
+        grammar = grammar_cache.get(key)
+        cache_hit = grammar is not None
+        if cache_hit:
+            grammar_cache.move_to_end(key)
+
+    compile_duration = 0
+    if not cache_hit:
+        # schema -> gbnf conversion is slow for big schemas, do it once
+        start = time.perf_counter_ns()
+        if key == 'json':
+            grammar = backend.compile_grammar()
+        else:
+            grammar = backend.compile_grammar(schema=schema)
+        compile_duration = time.perf_counter_ns() - start
+
+    with grammar_cache_lock:
+        if not cache_hit:
+            grammar_cache[key] = grammar
+            while len(grammar_cache) > GRAMMAR_CACHE_SIZE:
+                grammar_cache.popitem(last=False)
+
+        grammar_cache_stats['hits' if cache_hit else 'misses'] += 1
+        hit_rate = grammar_cache_stats['hits'] / (grammar_cache_stats['hits'] + grammar_cache_stats['misses'])
+
+    metrics = {
+        'grammar_compile_duration': compile_duration,
+        'grammar_cache_hit': cache_hit,
+        'grammar_cache_hit_rate': round(hit_rate, 4)
+    }
+    return grammar, metrics
+
+
+def get_openai_options(request_payload):
+    # OpenAI request fields on top of Ollama style `options` (extension)
+    options = dict(request_payload.get('options') or {})
+    for field, option in (
+        ('max_tokens', 'num_predict'),
+        ('max_completion_tokens', 'num_predict'),
+        ('temperature', 'temperature'),
+        ('top_p', 'top_p'),
+        ('seed', 'seed'),
+        ('frequency_penalty', 'frequency_penalty'),
+        ('presence_penalty', 'presence_penalty')
+    ):
+        if request_payload.get(field) is not None:
+            options[option] = request_payload[field]
+    return options
+
+
+def get_openai_format(response_format):
+    # OpenAI response_format -> Ollama format
+    if not response_format or response_format.get('type') == 'text':
+        return None
+    if response_format.get('type') == 'json_object':
+        return 'json'
+    if response_format.get('type') == 'json_schema':
+        return response_format.get('json_schema', {}).get('schema') or 'json'
+    raise ValueError(f'unsupported type "{response_format.get("type")}"')
+
+
+def get_message_text(content):
+    # OpenAI content may be a list of parts, only text parts are used
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+    return content or ''
+
+
+def get_sse_prefix(envelope):
+    # fields shared by all chunks of a stream are serialized once, a chunk only adds its choices
+    return b'data: ' + json.dumps(envelope)[:-1].encode('utf-8') + b', "choices": '
+
+
+def get_percentiles(samples):
+    if not samples:
+        return {'count': 0, 'p50': None, 'p95': None, 'max': None}
+
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50': round(ordered[len(ordered) // 2], 4),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        'max': round(ordered[-1], 4)
+    }
+
+
+def split_thinking(content, thinking=False):
+    # same split as a stream, `thinking` when the prompt opened the think block
+    splitter = ThinkSplitter(thinking)
+    think, answer = splitter.feed(content)
+    rest_think, rest_answer = splitter.flush()
+    return (think + rest_think).strip() or None, (answer + rest_answer).strip()
+
+
+class ThinkSplitter:
+    # Splits streamed text into thinking and answer. Tags may come split across chunks or
+    # glued to text, so a possible beginning of a tag is held back until the next chunk.
+    TAGS = ('<think>', '</think>')
+
+    def __init__(self, thinking=False, prompt=None):
+        # `prompt` - ThinkPrompt of the generation, decides `thinking` at the first chunk
+        self.thinking = thinking
+        self.prompt = prompt
+        self.buffer = ''
+        self.section_start = True
+
+    def emit(self, text, parts):
+        if self.section_start:
+            text = text.lstrip()
+            self.section_start = not text
+        parts[0 if self.thinking else 1] += text
+
+    def feed(self, text):
+        if self.prompt is not None:
+            self.thinking = bool(self.prompt.open)
+            self.prompt = None
+
+        parts = ['', '']
+        self.buffer += text
+
+        while True:
+            found = [(self.buffer.find(tag), tag) for tag in self.TAGS if tag in self.buffer]
+            if not found:
+                break
+
+            pos, tag = min(found)
+            self.emit(self.buffer[:pos], parts)
+            self.buffer = self.buffer[pos + len(tag):]
+            self.thinking = tag == '<think>'
+            self.section_start = True
+
+        keep = 0
+        for tag in self.TAGS:
+            for n in range(min(len(tag) - 1, len(self.buffer)), keep, -1):
+                if self.buffer.endswith(tag[:n]):
+                    keep = n
+                    break
+
+        self.emit(self.buffer[:len(self.buffer) - keep], parts)
+        self.buffer = self.buffer[len(self.buffer) - keep:]
+        return parts[0], parts[1]
+
+    def flush(self):
+        parts = ['', '']
+        self.emit(self.buffer, parts)
+        self.buffer = ''
+        return parts[0], parts[1]
+
+
+def find_last(tokens, pattern):
+    # index of the last occurrence of a token sequence, -1 if none
+    for index in range(len(tokens) - len(pattern), -1, -1):
+        if tokens[index:index + len(pattern)] == pattern:
+            return index
+    return -1
+
+
+def opens_think(input_ids, open_ids, close_ids):
+    # some chat templates open the think block in the prompt, often followed by a newline
+    tail = [int(t) for t in input_ids[-THINK_PROMPT_TAIL:]]
+    return find_last(tail, open_ids) > find_last(tail, close_ids)
+
+
+class ThinkPrompt:
+    # Logits processor for reasoning models: whether the prompt left a think block open,
+    # known from the first decode step on
+    def __init__(self, llm):
+        self.open_ids = backend.tokenize(llm, '<think>', special=True)
+        self.close_ids = backend.tokenize(llm, '</think>', special=True)
+        self.open = None
+
+    def __call__(self, input_ids, scores):
+        if self.open is None:
+            self.open = opens_think(input_ids, self.open_ids, self.close_ids)
+        return scores
+
+
+class ThinkControl:
+    # Logits processor for reasoning models: forces an empty think block when thinking is
+    # disabled and forces </think> when the thinking budget is spent.
+    def __init__(self, llm, think, budget):
+        self.open_ids = backend.tokenize(llm, '<think>', special=True)
+        self.close_ids = backend.tokenize(llm, '</think>', special=True)
+        self.newline_ids = backend.tokenize(llm, '\n\n', special=True)
+        self.think = think
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        # before every candidate
+        self.started = False
+        self.thinking = False
+        self.closed = False
+        self.think_tokens = 0
+        self.tail = []
+        self.forced = []
+
+    def __call__(self, input_ids, scores):
+        if not self.started:
+            self.started = True
+            self.thinking = opens_think(input_ids, self.open_ids, self.close_ids)
+
+            if self.think is False:
+                opening = [] if self.thinking else self.open_ids + self.newline_ids
+                self.forced = opening + self.close_ids + self.newline_ids
+        else:
+            # the token sampled in the previous step, context shift keeps the tail
+            self.tail = (self.tail + [int(input_ids[-1])])[-max(len(self.open_ids), len(self.close_ids)):]
+
+            if self.thinking and self.tail[-len(self.close_ids):] == self.close_ids:
+                self.thinking = False
+                self.closed = True
+            elif not self.thinking and not self.closed and self.tail[-len(self.open_ids):] == self.open_ids:
+                self.thinking = True
+
+        if self.thinking:
+            self.think_tokens += 1
+            if not self.forced and self.budget is not None and self.think_tokens > self.budget:
+                self.forced = self.newline_ids + self.close_ids + self.newline_ids
+
+        if self.forced:
+            token = self.forced.pop(0)
+            scores[:] = -np.inf
+            scores[token] = 0.0
+        return scores
+
+
+def get_base_model(model_info):
+    # LoRA variants: {"name": ..., "base": <model name>, "adapters": [{"filename": ..., "scale": 1.0}]}
+    if 'base' not in model_info:
+        return model_info, []
+
+    base_name = fix_model_name(model_info['base'])
+    base_info = next((e for e in get_models() if fix_model_name(e['name']) == base_name and 'base' not in e), None)
+    if not base_info:
+        raise ValueError(f'Base model "{base_name}" of "{model_info["name"]}" not found.')
+    return base_info, model_info.get('adapters', [])
+
+
+def get_file_size(filename):
+    full_path = os.path.join(os.path.expanduser(models_path), filename)
+    return os.path.getsize(full_path) if os.path.exists(full_path) else 0
+
+
+class LoadedModel:
+    # An instance of a base model. LoRA variants of the base share it, `model_info` and `name`
+    # are the variant of the current (or last) request.
+    def __init__(self, model_info, base_info, n_ctx, llm, load_duration, embedding=False):
+        self.model_info = model_info
+        self.name = fix_model_name(model_info['name'])
+        self.base_info = base_info
+        self.base_name = fix_model_name(base_info['name'])
+        self.n_ctx = n_ctx
+        self.embedding = embedding
+        self.llm = llm
+        self.load_duration = load_duration
+        self.loaded_at = datetime.datetime.utcnow()
+        self.last_used = time.perf_counter()
+        self.busy = True
+        self.paused = 0 # preempted requests waiting to get the instance back
+        self.stale = False # removed or changed in models.json
+        self.adapters = {} # filename -> loaded adapter
+        self.active_adapters = () # (filename, scale) applied to the context
+        self.variants = set() # names served by this instance
+
+
+class ModelPool:
+    # Loaded models are kept between requests, so a follow-up request to the same model
+    # reuses the kv cache for the common prompt prefix (e.g. chat history) instead of
+    # evaluating it again. An instance serves one request at a time, a concurrent one gets
+    # a fresh load. A paused (preempted) request lends its instance, see suspend.
+    def __init__(self, max_loaded=1):
+        self.max_loaded = max_loaded
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.models = []
+        self.adapter_stats = {
+            'switches': 0,
+            'switch_duration': collections.deque(maxlen=METRICS_WINDOW),
+            'loads': 0,
+            'load_duration': collections.deque(maxlen=METRICS_WINDOW)
+        }
+
+    def checkout(self, model_info, n_ctx, seed, embedding=False):
+        base_info, adapters = get_base_model(model_info)
+        active_adapters = tuple((a['filename'], float(a.get('scale', 1.0))) for a in adapters)
+
+        model = None
+        with self.lock:
+            # an instance with the same adapters keeps its kv cache, otherwise the most recently used one
+            idle = [m for m in self.models if not m.busy and m.n_ctx == n_ctx and m.embedding == embedding and m.base_info == base_info]
+            idle.sort(key=lambda m: (m.active_adapters == active_adapters, not m.paused, m.last_used), reverse=True)
+            if idle:
+                model = idle[0]
+                model.busy = True
+
+        if model is None:
+            start = time.perf_counter_ns()
+            llm = load_model(base_info, n_ctx, seed, embedding)
+            model = LoadedModel(model_info, base_info, n_ctx, llm, time.perf_counter_ns() - start, embedding)
+
+            with self.lock:
+                self.models.append(model)
+                self._evict()
+
+        try:
+            self.switch_adapters(model, active_adapters)
+        except Exception:
+            self.checkin(model)
+            raise
+
+        model.model_info = model_info
+        model.name = fix_model_name(model_info['name'])
+        model.variants.add(model.name)
+        return model
+
+    def switch_adapters(self, model, active_adapters):
+        # the instance is checked out, no lock needed for it
+        if model.active_adapters == active_adapters:
+            return
+
+        start = time.perf_counter_ns()
+        adapters = []
+        for filename, scale in active_adapters:
+            if filename not in model.adapters:
+                load_start = time.perf_counter_ns()
+                path = os.path.join(os.path.expanduser(models_path), filename)
+                adapter = backend.load_adapter(model.llm, path)
+                with self.lock:
+                    model.adapters[filename] = adapter
+                    self.adapter_stats['loads'] += 1
+                    self.adapter_stats['load_duration'].append((time.perf_counter_ns() - load_start) / 1e9)
+            adapters.append((model.adapters[filename], scale))
+
+        backend.set_adapters(model.llm, adapters)
+        model.active_adapters = active_adapters
+        # the kv cache was computed with other weights
+        backend.reset(model.llm)
+
+        with self.lock:
+            self.adapter_stats['switches'] += 1
+            self.adapter_stats['switch_duration'].append((time.perf_counter_ns() - start) / 1e9)
+
+    def get_adapter_metrics(self):
+        with self.lock:
+            cached = sum(len(m.adapters) for m in self.models)
+            cached_size = sum(get_file_size(f) for m in self.models for f in m.adapters)
+            # every variant beyond the first one on an instance would be a separate copy of the base
+            memory_saved = sum(get_file_size(m.base_info['filename']) * max(0, len(m.variants) - 1) for m in self.models)
+
+            return {
+                'switches': self.adapter_stats['switches'],
+                'switch_duration': get_percentiles(self.adapter_stats['switch_duration']),
+                'loads': self.adapter_stats['loads'],
+                'load_duration': get_percentiles(self.adapter_stats['load_duration']),
+                'cached': cached,
+                'cached_size': cached_size,
+                'memory_saved': memory_saved
+            }
+
+    def checkin(self, model):
+        with self.lock:
+            model.busy = False
+            model.last_used = time.perf_counter()
+            self._evict()
+            self.cond.notify_all()
+
+    def suspend(self, model):
+        # A preempted generation lends its instance to the requests that run meanwhile instead
+        # of making them load another copy of the weights. Its state (kv cache of its tokens)
+        # is copied to memory and restored when it gets the instance back, returns the callback
+        # that does it. The instance is not unloaded while it's lent.
+        state = backend.save_state(model.llm)
+        model_info, active_adapters = model.model_info, model.active_adapters
+
+        with self.lock:
+            model.paused += 1
+            model.busy = False
+            self.cond.notify_all()
+
+        def resume():
+            with self.lock:
+                self.cond.wait_for(lambda: not model.busy)
+                model.busy = True
+                model.paused -= 1
+
+            self.switch_adapters(model, active_adapters)
+            backend.load_state(model.llm, state)
+            model.model_info = model_info
+            model.name = fix_model_name(model_info['name'])
+        return resume
+
+    def retire(self, models_config):
+        # instances of models that are gone or changed are unloaded once they are idle
+        with self.lock:
+            for model in self.models:
+                if model.base_info not in models_config:
+                    model.stale = True
+            self._evict()
+
+    def _evict(self):
+        # stale and least recently used idle instances go first, busy ones are never unloaded
+        evicted = [m for m in self.models if not m.busy and not m.paused and m.stale]
+        idle = sorted((m for m in self.models if not m.busy and not m.paused and not m.stale), key=lambda m: m.last_used)
+        while len(self.models) - len(evicted) > self.max_loaded and idle:
+            evicted.append(idle.pop(0))
+
+        for model in evicted:
+            self.models.remove(model)
+            backend.unload(model.llm)
+
+    def list(self):
+        with self.lock:
+            return list(self.models)
+
+
+def get_file_fingerprint(filename):
+    # file size and mtime, hashing gigabytes on every request is too slow
+    full_path = os.path.join(os.path.expanduser(models_path), filename)
+    if not os.path.exists(full_path):
+        # stub backend
+        return f'{filename}:0:0'
+
+    stat = os.stat(full_path)
+    return f'{filename}:{stat.st_size}:{int(stat.st_mtime)}'
+
+
+def get_model_fingerprint(model_info):
+    # digest from models.json, base model and adapters for LoRA variants
+    if model_info.get('digest'):
+        return model_info['digest']
+
+    base_info, adapters = get_base_model(model_info)
+    fingerprint = base_info.get('digest') or get_file_fingerprint(base_info['filename'])
+    for adapter in adapters:
+        fingerprint += f'+{get_file_fingerprint(adapter["filename"])}*{float(adapter.get("scale", 1.0))}'
+    return fingerprint
+
+
+class SessionStore:
+    # Chat sessions. For every session the token ids it left in the kv cache are remembered
+    # (cheap), the llama.cpp state itself is copied only when a snapshot is saved to disk.
+    # A loaded snapshot waits in memory and is restored into the llm by the next request of
+    # the session, so only the new turn has to be evaluated.
+    def __init__(self, path=DEFAULT_SESSIONS_PATH, compression='zlib'):
+        self.path = path
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()
+        self.states = collections.OrderedDict()
+
+    def get_filename(self, session):
+        expanded_sessions_path = os.path.expanduser(self.path)
+        os.makedirs(expanded_sessions_path, exist_ok=True)
+        return os.path.join(expanded_sessions_path, f'{session}.session')
+
+    def update(self, session, model):
+        record = {
+            'model': model.name,
+            'fingerprint': get_model_fingerprint(model.model_info),
+            'n_ctx': model.n_ctx,
+            'tokens': backend.get_tokens(model.llm)
+        }
+
+        with self.lock:
+            self.sessions[session] = record
+            self.sessions.move_to_end(session)
+            while len(self.sessions) > SESSION_CACHE_SIZE:
+                self.sessions.popitem(last=False)
+
+    def get(self, session):
+        with self.lock:
+            return self.sessions.get(session)
+
+    def take_state(self, session, model):
+        with self.lock:
+            entry = self.states.pop(session, None)
+
+        if entry is None:
+            return None
+
+        header, state = entry
+        if header['fingerprint'] != get_model_fingerprint(model.model_info) or header['n_ctx'] != model.n_ctx:
+            return None
+        return state
+
+    def save(self, session, model, tokens):
+        llm = model.llm
+
+        # the llm may have served other requests since, evaluate the session again then
+        if backend.get_tokens(llm)[:len(tokens)] != tokens:
+            backend.reset(llm)
+            backend.evaluate(llm, tokens)
+
+        fields, payload = backend.dump_state(backend.save_state(llm))
+
+        header = {
+            'session': session,
+            'model': model.name,
+            'fingerprint': get_model_fingerprint(model.model_info),
+            'n_ctx': model.n_ctx,
+            'compression': self.compression
+        }
+        header.update(fields)
+
+        if self.compression == 'zlib':
+            payload = zlib.compress(payload, 1)
+        elif self.compression == 'lzma':
+            payload = lzma.compress(payload, preset=1)
+
+        filename = self.get_filename(session)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(SESSION_MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(payload)
+        os.replace(filename + '.tmp', filename)
+
+        header['size'] = os.path.getsize(filename)
+        return header
+
+    def load(self, session):
+        filename = self.get_filename(session)
+
+        with open(filename, 'rb') as f:
+            if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+                raise ValueError('not a vkllama session snapshot')
+
+            header = json.loads(f.readline().decode('utf-8'))
+            payload = f.read()
+
+        header['size'] = os.path.getsize(filename)
+
+        if header['compression'] == 'zlib':
+            payload = zlib.decompress(payload)
+        elif header['compression'] == 'lzma':
+            payload = lzma.decompress(payload)
+
+        state = backend.restore_state(header, payload)
+
+        with self.lock:
+            self.states[session] = (header, state)
+            self.states.move_to_end(session)
+            while len(self.states) > SESSION_STATES_SIZE:
+                self.states.popitem(last=False)
+
+            self.sessions[session] = {
+                'model': header['model'],
+                'fingerprint': header['fingerprint'],
+                'n_ctx': header['n_ctx'],
+                'tokens': backend.get_state_tokens(state)
+            }
+        return header
+
+    def discard(self, session, remove_file=True):
+        with self.lock:
+            self.states.pop(session, None)
+            self.sessions.pop(session, None)
+
+        filename = self.get_filename(session)
+        if remove_file and os.path.exists(filename):
+            os.remove(filename)
+
+
+session_store = SessionStore()
+
+
+class TokenCounter:
+    # Logits processor that sees every decode step: the prompt size at the first one
+    # (the prompt is evaluated, nothing is sampled yet) and the number of sampled tokens.
+    def __init__(self):
+        self.n_prompt = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        if self.n_prompt is None:
+            self.n_prompt = len(input_ids)
+        self.steps += 1
+        return scores
+
+
+class ContextWindow:
+    # Keeps a request inside the model context instead of failing:
+    #   truncate - drop the oldest turns from the prompt, system prompt is kept
+    #   shift    - truncate, and when the answer reaches the end of the context discard the
+    #              older half of the tokens after the prompt and shift the rest back in the kv
+    #              cache (llama.cpp context shift), so generation goes on without re-evaluation
+    #   none     - pass through, llama.cpp fails when the prompt doesn't fit
+    def __init__(self, llm, strategy):
+        self.llm = llm
+        self.strategy = strategy
+        self.report = {
+            'strategy': strategy,
+            'n_ctx': llm.n_ctx(),
+            'prompt_tokens': 0,
+            'dropped_messages': 0,
+            'dropped_tokens': 0,
+            'shifts': 0,
+            'shifted_tokens': 0
+        }
+        self.completion_tokens = 0 # of the last generate()
+
+    def count_tokens(self, message):
+        return len(backend.tokenize(self.llm, message.get('content') or '')) + MESSAGE_TOKEN_OVERHEAD
+
+    def fit(self, messages, max_tokens):
+        if self.strategy == 'none':
+            return messages
+
+        # leave some room for the answer
+        n_ctx = self.report['n_ctx']
+        reserve = n_ctx // 4 if max_tokens is None or max_tokens <= 0 else min(max_tokens, n_ctx // 4)
+        budget = n_ctx - reserve
+
+        n_system = 0
+        while n_system < len(messages) and messages[n_system]['role'] == 'system':
+            n_system += 1
+
+        counts = [self.count_tokens(m) for m in messages]
+        total = sum(counts)
+        # system messages are never dropped
+        if total <= budget or n_system == len(messages):
+            return messages
+
+        # Turns are dropped in blocks of about half the budget. Block borders only depend on the
+        # older messages, so the cut stays in place for the next turns and their prompts share
+        # the cached prefix, until the window fills up again and the cut moves by a whole block.
+        cuts = []
+        block = 0
+        for index in range(n_system + 1, len(messages)):
+            block += counts[index - 1]
+            # a turn is a message and everything up to the next user message
+            if messages[index]['role'] == 'user' and block >= budget * TRUNCATE_STEP:
+                cuts.append(index)
+                block = 0
+        cuts.append(len(messages) - 1)
+
+        for start in cuts:
+            dropped = sum(counts[n_system:start])
+            if total - dropped <= budget:
+                break
+
+        self.report['dropped_messages'] += start - n_system
+        self.report['dropped_tokens'] += dropped
+        return messages[:n_system] + messages[start:]
+
+    def count_steps(self, params):
+        # a TokenCounter in front of the request logits processors
+        counter = TokenCounter()
+        processors = vkllama_backend.LogitsProcessorList([counter])
+        processors.extend(params.get('logits_processor') or [])
+        return counter, dict(params, logits_processor=processors)
+
+    def get_pending(self, counter, text):
+        # the last sampled token is not evaluated, its ids are recovered from the streamed text
+        # that the evaluated ones don't cover
+        llm = self.llm
+        tokens = backend.get_tokens(llm)
+        generated = text.encode('utf-8')
+        evaluated = backend.detokenize(llm, tokens[counter.n_prompt:], prev_tokens=tokens[:counter.n_prompt])
+        if not generated.startswith(evaluated) or len(generated) == len(evaluated):
+            return []
+        return backend.tokenize(llm, generated[len(evaluated):].decode('utf-8', errors='ignore'), special=True)
+
+    def shift(self, n_keep, pending):
+        llm = self.llm
+
+        # the pending tokens go back after the kept window
+        tokens = backend.get_tokens(llm) + pending
+        n_past = backend.get_n_tokens(llm)
+
+        n_keep = min(n_keep, self.report['n_ctx'] // 2)
+        n_discard = (n_past - n_keep) // 2
+        if n_discard <= 0:
+            return None
+
+        kept = tokens[:n_keep] + tokens[n_keep + n_discard:]
+        # without kv shift in the runtime the kept window gets evaluated again
+        backend.shift_context(llm, n_keep, n_discard)
+
+        self.report['shifts'] += 1
+        self.report['shifted_tokens'] += n_discard
+        return kept
+
+    def generate(self, messages, max_tokens, **params):
+        # chat completion stream chunks, continued through context shifts
+        llm = self.llm
+        can_shift = self.strategy == 'shift' and params.get('grammar') is None
+        remaining = max_tokens if max_tokens and max_tokens > 0 else SHIFT_MAX_TOKENS_FACTOR * self.report['n_ctx']
+        self.completion_tokens = 0
+
+        counter, segment_params = self.count_steps(params)
+        out = backend.chat_complete(llm, messages, max_tokens, stream=True, **segment_params)
+        n_prompt = None
+
+        while True:
+            text = ''
+            finish_reason = None
+
+            for chunk in out:
+                choice = chunk['choices'][0]
+                piece = (choice['delta'].get('content') or '') if 'delta' in choice else choice.get('text', '')
+                text += piece
+
+                if n_prompt is None and counter.n_prompt is not None:
+                    n_prompt = counter.n_prompt
+                    self.report['prompt_tokens'] = n_prompt
+
+                finish_reason = choice.get('finish_reason')
+                if piece or finish_reason is None:
+                    yield {'choices': [{'delta': {'content': piece}, 'finish_reason': None}]}
+                if finish_reason is not None:
+                    break
+
+            # decode steps, the one that samples the end of generation token is not an answer token
+            self.completion_tokens += counter.steps - (1 if finish_reason == 'stop' and counter.steps else 0)
+            remaining -= counter.steps
+
+            # stopped by the end of the context, not by the token limit
+            if finish_reason == 'length' and can_shift and remaining > 0 and n_prompt is not None \
+                    and backend.get_n_tokens(llm) + 1 >= self.report['n_ctx']:
+                tokens = self.shift(n_prompt, self.get_pending(counter, text))
+                if tokens:
+                    counter, segment_params = self.count_steps(params)
+                    out = backend.complete(llm, tokens, remaining, stream=True, **segment_params)
+                    continue
+
+            yield {'choices': [{'delta': {}, 'finish_reason': finish_reason or 'stop'}]}
+            return
+
+    def complete(self, messages, max_tokens, **params):
+        # same as non streaming create_chat_completion
+        if self.strategy != 'shift':
+            completion = backend.chat_complete(self.llm, messages, max_tokens, stream=False, **params)
+            self.report['prompt_tokens'] = completion['usage']['prompt_tokens']
+            return completion
+
+        content = ''
+        finish_reason = 'stop'
+
+        for chunk in self.generate(messages, max_tokens, **params):
+            choice = chunk['choices'][0]
+            if choice['finish_reason'] is not None:
+                finish_reason = choice['finish_reason']
+            else:
+                content += choice['delta'].get('content') or ''
+
+        return {
+            'choices': [{
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': finish_reason
+            }],
+            'usage': {
+                'prompt_tokens': self.report['prompt_tokens'],
+                'completion_tokens': self.completion_tokens,
+                'total_tokens': self.report['prompt_tokens'] + self.completion_tokens
+            }
+        }
+
+    def generate_text(self, prompt, max_tokens, **params):
+        # raw text completion as chat style stream chunks, the prompt is passed through as is
+        counter, params = self.count_steps(params)
+        for chunk in backend.complete(self.llm, prompt, max_tokens, stream=True, **params):
+            if counter.n_prompt is not None:
+                self.report['prompt_tokens'] = counter.n_prompt
+
+            choice = chunk['choices'][0]
+            yield {'choices': [{'delta': {'content': choice.get('text', '')}, 'finish_reason': choice.get('finish_reason')}]}
+
+    def complete_text(self, prompt, max_tokens, **params):
+        completion = backend.complete(self.llm, prompt, max_tokens, stream=False, **params)
+        self.report['prompt_tokens'] = completion['usage']['prompt_tokens']
+        return completion
+
+
+model_pool = ModelPool()
+
+
+class Ticket:
+    def __init__(self, priority):
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES[priority]['rank']
+        self.created_at = time.perf_counter()
+        self.queued_at = self.created_at
+        self.queue_wait = 0.0
+        self.ttft = None
+        self.tokens = 0 # decode steps, charged to the class
+        self.generated = 0 # tokens of the answers
+        self.generation_start = 0
+        self.preemptions = 0
+        self.granted = False
+        self.on_pause = None # releases the model of a paused generation, returns the callback to get it back
+
+
+    def end_generation(self, finish_reason):
+        # logits processors also run for the step that samples the end of generation token,
+        # which is not part of the answer (an answer cut by a stop string is counted one short)
+        self.generated += self.tokens - self.generation_start - (1 if finish_reason == 'stop' else 0)
+        self.generation_start = self.tokens
+
+
+class Scheduler:
+    # Weighted fair queuing of generations between priority classes (start-time fair queuing).
+    # Every decoded token is charged to the class virtual time (1 / weight), a free slot goes
+    # to the waiting class with the lowest virtual time. The virtual clock is the lowest virtual
+    # time of the running and waiting classes, a class that becomes busy starts from it, so it
+    # gets neither credit nor debt from the time it was idle. Running generations check in on
+    # every token and pause when a waiting higher priority class would get their slot.
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.cond = threading.Condition()
+        self.running = 0
+        self.running_classes = collections.Counter()
+        self.waiting = {cls: collections.deque() for cls in PRIORITY_CLASSES}
+        self.virtual_time = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self.virtual_clock = 0.0
+        self.metrics = {
+            cls: {
+                'requests': 0,
+                'preemptions': 0,
+                'slo_violations': 0,
+                'queue_wait': collections.deque(maxlen=METRICS_WINDOW),
+                'ttft': collections.deque(maxlen=METRICS_WINDOW)
+            } for cls in PRIORITY_CLASSES
+        }
+
+    def _update_clock(self):
+        busy = [cls for cls in PRIORITY_CLASSES if self.waiting[cls] or self.running_classes[cls]]
+        # an idle system continues from the latest service
+        clock = min(self.virtual_time[cls] for cls in busy) if busy else max(self.virtual_time.values())
+        self.virtual_clock = max(self.virtual_clock, clock)
+
+    def _enqueue(self, ticket, front=False):
+        queue = self.waiting[ticket.priority]
+        if not queue and not self.running_classes[ticket.priority]:
+            # class becomes busy, don't let it spend credit saved while idle
+            self._update_clock()
+            self.virtual_time[ticket.priority] = max(self.virtual_time[ticket.priority], self.virtual_clock)
+
+        ticket.queued_at = time.perf_counter()
+        if front:
+            queue.appendleft(ticket)
+        else:
+            queue.append(ticket)
+
+    def _next_class(self, classes):
+        return min(classes, key=lambda c: (self.virtual_time[c], -PRIORITY_CLASSES[c]['rank']))
+
+    def _dispatch(self):
+        while self.running < self.slots:
+            backlogged = [cls for cls, queue in self.waiting.items() if queue]
+            if not backlogged:
+                break
+
+            cls = self._next_class(backlogged)
+            ticket = self.waiting[cls].popleft()
+            ticket.granted = True
+            ticket.queue_wait += time.perf_counter() - ticket.queued_at
+
+            self.running += 1
+            self.running_classes[cls] += 1
+
+        self._update_clock()
+        self.cond.notify_all()
+
+    def _wait_granted(self, ticket):
+        self._dispatch()
+        while not ticket.granted:
+            self.cond.wait()
+
+    def acquire(self, priority):
+        ticket = Ticket(priority)
+
+        with self.cond:
+            self.metrics[priority]['requests'] += 1
+            self._enqueue(ticket)
+            self._wait_granted(ticket)
+        return ticket
+
+    def release(self, ticket):
+        with self.cond:
+            if ticket.granted:
+                ticket.granted = False
+                self.running -= 1
+                self.running_classes[ticket.priority] -= 1
+
+            metrics = self.metrics[ticket.priority]
+            metrics['queue_wait'].append(ticket.queue_wait)
+            if ticket.ttft is not None:
+                metrics['ttft'].append(ticket.ttft)
+                if ticket.ttft > PRIORITY_CLASSES[ticket.priority]['slo_ttft']:
+                    metrics['slo_violations'] += 1
+
+            self._dispatch()
+
+    def yield_point(self, ticket):
+        # called between tokens
+        if ticket.ttft is None:
+            ticket.ttft = time.perf_counter() - ticket.created_at
+        ticket.tokens += 1
+
+        with self.cond:
+            self.virtual_time[ticket.priority] += 1.0 / PRIORITY_CLASSES[ticket.priority]['weight']
+            if not self._preempts(ticket):
+                return
+
+        # pause at token boundary, the model is lent to the preempting request while we wait
+        resume = ticket.on_pause() if ticket.on_pause else None
+
+        with self.cond:
+            if self._preempts(ticket):
+                self._pause(ticket)
+
+        if resume:
+            resume()
+
+    def _pause(self, ticket):
+        # the class keeps its virtual time
+        self._enqueue(ticket, front=True)
+        ticket.granted = False
+        self.running -= 1
+        self.running_classes[ticket.priority] -= 1
+        self._dispatch()
+
+        # only a slot that changed hands is a preemption
+        if not ticket.granted:
+            ticket.preemptions += 1
+            self.metrics[ticket.priority]['preemptions'] += 1
+        self._wait_granted(ticket)
+
+    def _preempts(self, ticket):
+        # a waiting higher priority class would win the slot over the running ticket
+        if not any(queue and PRIORITY_CLASSES[cls]['rank'] > ticket.rank for cls, queue in self.waiting.items()):
+            return False
+        backlogged = [cls for cls, queue in self.waiting.items() if queue]
+        return PRIORITY_CLASSES[self._next_class(backlogged + [ticket.priority])]['rank'] > ticket.rank
+
+    def token_hook(self, ticket):
+        # llama.cpp calls logits processors once per sampled token
+        def hook(input_ids, scores):
+            self.yield_point(ticket)
+            return scores
+        return hook
+
+    def get_metrics(self):
+        with self.cond:
+            classes = {}
+            for cls, metrics in self.metrics.items():
+                classes[cls] = {
+                    'weight': PRIORITY_CLASSES[cls]['weight'],
+                    'waiting': len(self.waiting[cls]),
+                    'requests': metrics['requests'],
+                    'preemptions': metrics['preemptions'],
+                    'slo_ttft': PRIORITY_CLASSES[cls]['slo_ttft'],
+                    'slo_violations': metrics['slo_violations'],
+                    'queue_wait': get_percentiles(metrics['queue_wait']),
+                    'ttft': get_percentiles(metrics['ttft'])
+                }
+
+            return {
+                'slots': self.slots,
+                'running': self.running,
+                'classes': classes
+            }
+
+
+scheduler = Scheduler()
+
+
+class TokenBucket:
+    # `rate` per second up to `capacity`, the level may go negative when usage is charged afterwards
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # seconds until `amount` is available
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class ClientUsage:
+    def __init__(self, limits):
+        self.lock = threading.Lock()
+        self.configure(limits)
+        self.requests = 0
+        self.rejected = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.last_seen = time.monotonic()
+
+    def configure(self, limits):
+        # 0 - unlimited
+        self.limits = limits
+        rps = limits['requests_per_second']
+        tpm = limits['tokens_per_minute']
+        self.request_bucket = TokenBucket(rps, max(1.0, rps)) if rps > 0 else None
+        self.token_bucket = TokenBucket(tpm / 60.0, tpm) if tpm > 0 else None
+
+
+class RateLimiter:
+    # Per client and model token buckets. Requests are admitted before any model work and reserve
+    # the tokens they may use; the unused part is refunded once when the request is done, so
+    # streaming never touches the counters.
+    # Every client has its own lock, the global one is only taken for new clients.
+    def __init__(self):
+        self.default_limits = {'requests_per_second': 0, 'tokens_per_minute': 0}
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get_limits(self, model_info):
+        # `limits` in models.json override the server defaults
+        return dict(self.default_limits, **model_info.get('limits', {}))
+
+    def get_usage(self, client, model_name, limits):
+        key = (client, model_name)
+        usage = self.clients.get(key)
+        if usage is None:
+            with self.lock:
+                usage = self.clients.get(key)
+                if usage is None:
+                    self._prune()
+                    usage = self.clients[key] = ClientUsage(limits)
+        return usage
+
+    def _prune(self):
+        if len(self.clients) < RATE_LIMIT_CLIENTS:
+            return
+        deadline = time.monotonic() - RATE_LIMIT_IDLE
+        for key in [k for k, u in self.clients.items() if u.last_seen < deadline]:
+            del self.clients[key]
+
+    def admit(self, client, model_name, model_info, tokens):
+        # reserves `tokens`, returns None or (seconds to wait, 'requests' | 'tokens')
+        limits = self.get_limits(model_info)
+        usage = self.get_usage(client, model_name, limits)
+
+        with usage.lock:
+            if usage.limits != limits:
+                usage.configure(limits)
+
+            now = time.monotonic()
+            usage.last_seen = now
+
+            if usage.token_bucket:
+                usage.token_bucket.refill(now)
+                # a reservation larger than the bucket needs a full one
+                needed = min(tokens, usage.token_bucket.capacity)
+                if usage.token_bucket.level < needed:
+                    usage.rejected += 1
+                    return usage.token_bucket.wait_time(needed), 'tokens'
+
+            if usage.request_bucket:
+                usage.request_bucket.refill(now)
+                if usage.request_bucket.level < 1.0:
+                    usage.rejected += 1
+                    return usage.request_bucket.wait_time(1.0), 'requests'
+                usage.request_bucket.level -= 1.0
+
+            if usage.token_bucket:
+                usage.token_bucket.level -= tokens
+            usage.requests += 1
+        return None
+
+    def charge(self, client, model_name, reserved, prompt_tokens, eval_tokens):
+        # settles the reservation of admit() with the used tokens
+        usage = self.clients.get((client, model_name))
+        if usage is None:
+            return
+
+        with usage.lock:
+            usage.prompt_tokens += prompt_tokens
+            usage.eval_tokens += eval_tokens
+            if usage.token_bucket:
+                usage.token_bucket.refill(time.monotonic())
+                usage.token_bucket.level = min(usage.token_bucket.capacity, usage.token_bucket.level + reserved - prompt_tokens - eval_tokens)
+
+    def report(self, client=None):
+        now = time.monotonic()
+        with self.lock:
+            items = list(self.clients.items())
+
+        report = []
+        for (usage_client, model_name), usage in items:
+            if client is not None and usage_client != client:
+                continue
+
+            with usage.lock:
+                buckets = {}
+                for name, bucket in (('requests', usage.request_bucket), ('tokens', usage.token_bucket)):
+                    if bucket:
+                        bucket.refill(now)
+                        buckets[name] = round(bucket.level, 2)
+
+                report.append({
+                    'client': usage_client,
+                    'model': model_name,
+                    'limits': usage.limits,
+                    'available': buckets,
+                    'requests': usage.requests,
+                    'rejected': usage.rejected,
+                    'prompt_tokens': usage.prompt_tokens,
+                    'eval_tokens': usage.eval_tokens,
+                    'idle': round(now - usage.last_seen, 1)
+                })
+        return report
+
+
+rate_limiter = RateLimiter()
+
+
+class Span:
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.thread_id = threading.get_ident()
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def end(self, **attributes):
+        self.attributes.update(attributes)
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end()
+
+
+class NoSpan:
+    # span of a request that is not sampled
+    attributes = {}
+
+    def end(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Trace:
+    # Phases of one request. Not sampled traces cost a few attribute lookups.
+    def __init__(self, request_id, name, sampled):
+        self.request_id = request_id
+        self.sampled = sampled
+        self.spans = []
+        self.phase = None
+        self.phase_attributes = {}
+        self.write_duration = 0
+        self.writes = 0
+        self.root = self.span(name) if sampled else NO_SPAN
+
+    def span(self, name, **attributes):
+        if not self.sampled:
+            return NO_SPAN
+
+        parent_id = self.spans[0].span_id if self.spans else None
+        span = Span(name, parent_id, attributes)
+        self.spans.append(span)
+        return span
+
+    def set(self, **attributes):
+        if self.sampled:
+            self.root.attributes.update(attributes)
+
+    def begin_generation(self, **attributes):
+        # chat template rendering happens inside llama-cpp-python, it is part of prompt_eval
+        self.phase_attributes = attributes
+        self.phase = self.span('prompt_eval', **attributes)
+
+    def on_token(self, input_ids, scores):
+        # logits processor: the first call comes right after the prompt is evaluated
+        if self.phase is not None and self.phase.name == 'prompt_eval':
+            self.phase.end(prompt_tokens=len(input_ids))
+            self.phase = self.span('decode', tokens=0, **self.phase_attributes)
+        if self.phase is not None:
+            self.phase.attributes['tokens'] += 1
+        return scores
+
+    def end_generation(self):
+        if self.phase is not None:
+            self.phase.end()
+        self.phase = None
+
+    def add_write(self, duration):
+        self.write_duration += duration
+        self.writes += 1
+
+    def finish(self):
+        self.end_generation()
+        self.root.end(socket_write_duration=self.write_duration, socket_writes=self.writes)
+
+
+class Tracer:
+    # Samples requests and appends their spans to a chrome trace (chrome://tracing, perfetto)
+    # or an OTLP-JSON file (one ExportTraceServiceRequest per line).
+    def __init__(self):
+        self.path = None
+        self.sample_rate = 0.0
+        self.format = 'chrome'
+        self.lock = threading.Lock()
+
+    def new_trace(self, name):
+        request_id = uuid.uuid4().hex
+        sampled = self.path is not None and random.random() < self.sample_rate
+        return Trace(request_id, name, sampled)
+
+    def to_chrome(self, trace):
+        lines = []
+        for span in trace.spans:
+            event = {
+                'name': span.name,
+                'cat': 'vkllama',
+                'ph': 'X',
+                'ts': span.start_ns / 1000,
+                'dur': ((span.end_ns or span.start_ns) - span.start_ns) / 1000,
+                'pid': os.getpid(),
+                'tid': span.thread_id,
+                'args': dict(span.attributes, request_id=trace.request_id)
+            }
+            lines.append(json.dumps(event) + ',\n')
+        return ''.join(lines)
+
+    def to_otlp(self, trace):
+        def to_value(value):
+            if isinstance(value, bool):
+                return {'boolValue': value}
+            if isinstance(value, int):
+                return {'intValue': str(value)}
+            if isinstance(value, float):
+                return {'doubleValue': value}
+            return {'stringValue': str(value)}
+
+        spans = []
+        for span in trace.spans:
+            spans.append({
+                'traceId': trace.request_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': 2 if span.parent_id is None else 1, # server / internal
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns or span.start_ns),
+                'attributes': [{'key': k, 'value': to_value(v)} for k, v in span.attributes.items()]
+            })
+
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'vkllama'}}]},
+                'scopeSpans': [{'scope': {'name': 'vkllama'}, 'spans': spans}]
+            }]
+        }
+        return json.dumps(payload) + '\n'
+
+    def export(self, trace):
+        if not trace.sampled:
+            return
+
+        trace.finish()
+        data = self.to_chrome(trace) if self.format == 'chrome' else self.to_otlp(trace)
+
+        with self.lock:
+            # chrome trace viewers accept a json array without the closing bracket
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a') as f:
+                if new_file and self.format == 'chrome':
+                    f.write('[\n')
+                f.write(data)
+
+
+def sample_profile(seconds, interval):
+    # py-spy like sampling of python threads, result is in folded stacks format (flamegraph.pl, speedscope)
+    own_thread_id = threading.get_ident()
+    stacks = collections.Counter()
+    samples = 0
+
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+
+            stacks[';'.join(reversed(stack))] += 1
+
+        samples += 1
+        time.sleep(interval)
+
+    return stacks, samples
+
+
+tracer = Tracer()
+profile_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    # token bucket: at most `rate` records per `period` seconds, dropped ones are reported with the next record
+    def __init__(self, rate, period):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self.allowance = float(rate)
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate / self.period)
+            self.last = now
+
+            if self.allowance < 1.0:
+                self.suppressed += 1
+                return False
+
+            self.allowance -= 1.0
+            if self.suppressed:
+                record.msg = f'{record.msg} ({self.suppressed} similar errors suppressed)'
+                self.suppressed = 0
+        return True
+
+
+# request threads only put records into a queue, a listener thread formats, writes and rotates files
+access_logger = logging.getLogger('vkllama.access')
+access_logger.propagate = False
+access_logger.setLevel(logging.INFO)
+
+error_logger = logging.getLogger('vkllama.error')
+error_logger.propagate = False
+error_logger.setLevel(logging.ERROR)
+error_logger.addFilter(RateLimitFilter(ERROR_LOG_RATE, ERROR_LOG_PERIOD))
+
+
+def start_logging(access_log, max_bytes, backups, error_log):
+    log_queue = queue.SimpleQueue()
+    handlers = []
+
+    if access_log:
+        path = os.path.expanduser(access_log)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        access_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        access_handler.setFormatter(logging.Formatter('%(message)s'))
+        access_handler.addFilter(logging.Filter(access_logger.name))
+        handlers.append(access_handler)
+        access_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    if error_log:
+        path = os.path.expanduser(error_log)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        error_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    else:
+        error_handler = logging.StreamHandler(sys.stderr)
+    error_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(message)s'))
+    error_handler.addFilter(logging.Filter(error_logger.name))
+    handlers.append(error_handler)
+    error_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+class Generation:
+    # A request that got its device slot and model instance
+    # (see VKLlamaRequestHandler.start_generation).
+    def __init__(self, trace, ticket, model, seed, sampling_params, num_candidates, context_strategy, grammar, grammar_metrics, thinking, think_prompt, think_control, token_hook):
+        self.trace = trace
+        self.ticket = ticket
+        self.model = model
+        self.llm = model.llm
+        self.seed = seed
+        self.context_strategy = context_strategy
+        self.sampling_params = sampling_params
+        self.num_candidates = num_candidates
+        self.grammar = grammar
+        self.grammar_metrics = grammar_metrics
+        self.thinking = thinking
+        self.think_prompt = think_prompt
+        self.think_control = think_control
+        self.token_hook = token_hook
+
+    def new_splitter(self):
+        # stream splitter of a candidate, None without thinking
+        return ThinkSplitter(prompt=self.think_prompt) if self.thinking else None
+
+    def split_thinking(self, content):
+        # (thinking, answer) of a whole answer
+        return split_thinking(content, bool(self.think_prompt and self.think_prompt.open))
+
+    def begin_candidate(self, index):
+        # returns the generation parameters of the candidate
+        self.trace.begin_generation(candidate=index)
+        if self.think_control:
+            self.think_control.reset()
+        return {
+            'seed': get_candidate_seed(self.seed, index),
+            'grammar': self.grammar,
+            'logits_processor': self.token_hook,
+            **self.sampling_params
+        }
+
+    def end_candidate(self, finish_reason):
+        self.trace.end_generation()
+        self.ticket.end_generation(finish_reason)
 
 
 class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
+    def begin_request(self):
+        self.url = urllib.parse.urlsplit(self.path)
+        self.status_code = None
+        self.trace = tracer.new_trace(f'{self.command} {self.url.path}')
+        self.trace.set(route=self.url.path, client=self.client_address[0])
+        self.started_at = time.perf_counter()
+        self.access = {}
+        self.retry_after = None
+        self.rate_limited = None # (client, model, reserved tokens) to charge the used tokens to
+        self.ticket = None # device slot and model instance of a generation request
+        self.model = None
+
+    def annotate(self, **fields):
+        # goes to both the access log record and the trace
+        self.access.update(fields)
+        self.trace.set(**fields)
+
+    def annotate_ticket(self, ticket):
+        # ticket times count from the queue entry, the access log counts from the request start
+        self.access['queue_wait'] = ticket.queue_wait
+        if ticket.ttft is not None:
+            self.access['ttft'] = ticket.created_at + ticket.ttft - self.started_at
+        self.access['eval_count'] = ticket.generated
+        self.access['preemptions'] = ticket.preemptions
+
+    def finish_request(self):
+        self.trace.set(status=self.status_code)
+        tracer.export(self.trace)
+
+        if self.rate_limited:
+            rate_limiter.charge(*self.rate_limited, self.access.get('prompt_eval_count', 0), self.access.get('eval_count', 0))
+
+        if access_logger.handlers:
+            record = {
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                'request_id': self.trace.request_id,
+                'client': self.client_address[0],
+                'method': self.command,
+                'route': self.url.path,
+                'status': self.status_code,
+                'duration': time.perf_counter() - self.started_at
+            }
+            record.update(self.access)
+            access_logger.info(json.dumps(record))
+
+    def end_headers(self):
+        # malformed requests are answered before begin_request
+        if hasattr(self, 'trace'):
+            self.send_header('X-Request-Id', self.trace.request_id)
+            if self.retry_after is not None:
+                self.send_header('Retry-After', str(max(1, int(self.retry_after + 0.999))))
+        super().end_headers()
+
+    def log_request(self, code='-', size='-'):
+        self.status_code = int(code) if isinstance(code, int) else code
+
+    def write(self, data):
+        if not self.trace.sampled:
+            self.wfile.write(data)
+            return
+
+        start = time.perf_counter_ns()
+        self.wfile.write(data)
+        self.trace.add_write(time.perf_counter_ns() - start)
+
     def do_GET(self):
-        if self.path == '/api/tags':
-            self.handle_list_models()
-        elif self.path == '/api/ps':
-            self.handle_list_running()
-        else:
-            self.send_error(404, 'Not Found')
+        self.begin_request()
+        try:
+            if self.url.path == '/api/tags':
+                self.handle_list_models()
+            elif self.url.path == '/api/ps':
+                self.handle_list_running()
+            elif self.url.path == '/api/metrics':
+                self.handle_metrics()
+            elif self.url.path == '/api/debug/profile':
+                self.handle_profile()
+            elif self.url.path == '/api/usage':
+                self.handle_usage()
+            elif self.url.path == '/v1/models':
+                self.handle_openai_models()
+            else:
+                self.send_error(404, 'Not Found')
+        finally:
+            self.finish_request()
 
     def handle_list_models(self):
         try:
@@ -69,14 +1715,19 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
             models = []
             for model_info in get_models():
                 model_name = fix_model_name(model_info['name'])
-                full_model_path = os.path.join(expanded_models_path, model_info['filename'])
+                try:
+                    base_info, _ = get_base_model(model_info)
+                except ValueError as e:
+                    error_logger.error(str(e))
+                    continue
+                full_model_path = os.path.join(expanded_models_path, base_info['filename'])
 
                 # get info
                 size = 0
                 modified_at = datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z' 
                 digest = model_info.get('digest', None)
-                qlevel = model_info.get('quantization_level', None)
-                psize = model_info.get('parameter_size', None)
+                qlevel = model_info.get('quantization_level', base_info.get('quantization_level', None))
+                psize = model_info.get('parameter_size', base_info.get('parameter_size', None))
 
                 if os.path.exists(full_model_path):
                     size = os.path.getsize(full_model_path)
@@ -92,7 +1743,7 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
                     'size': size,
                     'digest': digest,
                     'details': {
-                        'parent_model': '',
+                        'parent_model': fix_model_name(model_info['base']) if 'base' in model_info else '',
                         'format': 'gguf',
                         'family': model_name,
                         'families': [model_name],
@@ -106,32 +1757,282 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            self.wfile.write(json.dumps(response_payload).encode('utf-8'))
+            self.write(json.dumps(response_payload).encode('utf-8'))
 
         except FileNotFoundError:
             self.send_error(500, 'Internal Server Error', 'models.json not found in the models directory.')
         except json.JSONDecodeError:
             self.send_error(500, 'Internal Server Error', 'Error parsing models.json. Check file format.')
         except Exception as e:
-            print(f'Error handling /api/tags: {e}')
+            error_logger.exception(f'{self.trace.request_id} error handling /api/tags: {e}')
             self.send_error(500, 'Internal Server Error', f'An unexpected error occurred: {e}')
 
-    def handle_list_running():
-        pass
+    def handle_list_running(self):
+        expanded_models_path = os.path.expanduser(models_path)
+        models = []
+
+        for model in model_pool.list():
+            full_model_path = os.path.join(expanded_models_path, model.base_info['filename'])
+            base_size = os.path.getsize(full_model_path) if os.path.exists(full_model_path) else 0
+            adapters = list(model.adapters)
+            adapters_size = sum(get_file_size(f) for f in adapters)
+            size = base_size + adapters_size
+
+            models.append({
+                'name': model.name,
+                'model': model.name,
+                'size': size,
+                'size_vram': size, # all layers are offloaded
+                'digest': model.base_info.get('digest', None),
+                'details': {
+                    'parent_model': model.base_name if model.name != model.base_name else '',
+                    'format': 'gguf',
+                    'family': model.base_name,
+                    'families': [model.base_name],
+                    'quantization_level': model.base_info.get('quantization_level', None),
+                    'parameter_size': model.base_info.get('parameter_size', None)
+                },
+                'loaded_at': model.loaded_at.isoformat(timespec='milliseconds') + 'Z',
+                'load_duration': model.load_duration,
+                'context_length': model.n_ctx,
+                'busy': model.busy,
+                'paused': model.paused,
+                'adapters': {
+                    'active': [{'filename': f, 'scale': scale} for f, scale in model.active_adapters],
+                    'cached': adapters,
+                    'cached_size': adapters_size,
+                    'variants': sorted(model.variants),
+                    # the variants would be separate copies of the base model without adapters
+                    'memory_saved': base_size * max(0, len(model.variants) - 1)
+                }
+            })
 
-    def do_POST(self):
-        if self.path == '/api/generate':
-            self.handle_generate()
-        elif self.path == '/api/chat':
-            self.handle_chat_completion()
+        response_payload = {'models': models}
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.write(json.dumps(response_payload).encode('utf-8'))
+
+    def handle_metrics(self):
+        response_payload = {'scheduler': scheduler.get_metrics(), 'adapters': model_pool.get_adapter_metrics()}
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.write(json.dumps(response_payload).encode('utf-8'))
+
+    def handle_usage(self):
+        # ?all=1 for every client (local callers only), otherwise the caller only
+        query = urllib.parse.parse_qs(self.url.query)
+        client = self.get_client()
+        show_all = query.get('all', ['0'])[0] in ('1', 'true')
+
+        if show_all and not self.is_local():
+            self.send_error(403, 'Forbidden', 'Usage of all clients is only shown to local callers.')
+            return
+
+        response_payload = {
+            'client': client,
+            'default_limits': rate_limiter.default_limits,
+            'usage': rate_limiter.report(None if show_all else client)
+        }
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.write(json.dumps(response_payload).encode('utf-8'))
+
+    def handle_profile(self):
+        # thread stacks and a handler thread busy for seconds, not for remote clients
+        if not self.is_local():
+            self.send_error(403, 'Forbidden', 'Profiling is only available to local callers.')
+            return
+
+        query = urllib.parse.parse_qs(self.url.query)
+
+        try:
+            seconds = min(float(query.get('seconds', ['5'])[0]), MAX_PROFILE_SECONDS)
+            interval = max(float(query.get('interval', ['0.01'])[0]), 0.001)
+        except ValueError:
+            self.send_error(400, 'Bad Request', 'Invalid "seconds" or "interval".')
+            return
+
+        if not profile_lock.acquire(blocking=False):
+            self.send_error(409, 'Conflict', 'Another profile is running.')
+            return
+
+        try:
+            stacks, samples = sample_profile(seconds, interval)
+        finally:
+            profile_lock.release()
+
+        body = ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('X-Profile-Samples', str(samples))
+        self.end_headers()
+        self.write(body.encode('utf-8'))
+
+    def is_local(self):
+        # loopback peer, behind a local reverse proxy every client is local
+        return ipaddress.ip_address(self.client_address[0]).is_loopback
+
+    def get_client(self):
+        # API key (Authorization: Bearer or X-API-Key), otherwise the source address
+        auth = self.headers.get('Authorization', '')
+        key = auth[7:].strip() if auth.lower().startswith('bearer ') else self.headers.get('X-API-Key')
+        if key:
+            return 'key:' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        return self.client_address[0]
+
+    def check_rate_limit(self, model_name, model_info, tokens, openai=False):
+        # answered before the request is queued or a model is loaded
+        client = self.get_client()
+        self.annotate(client_id=client)
+
+        limited = rate_limiter.admit(client, model_name, model_info, tokens)
+        if limited is None:
+            self.rate_limited = (client, model_name, tokens)
+            return True
+
+        self.retry_after, kind = limited
+        message = f'Rate limit exceeded ({kind}) for model "{model_name}". Retry in {self.retry_after:.1f} s.'
+        if openai:
+            self.send_openai_error(429, message, kind, 'rate_limit_exceeded')
         else:
-            self.send_error(404, 'Not Found')
+            self.send_error(429, 'Too Many Requests', message)
+        return False
+
+    def get_priority(self, options):
+        # header wins over options, so proxies can classify traffic
+        return self.headers.get('X-Priority') or options.get('priority', DEFAULT_PRIORITY)
+
+    def start_generation(self, request_payload, options, model_name, response_format, format_field='format', openai=False):
+        # checks shared by /api/generate, /api/chat and the OpenAI completions, then waits for
+        # a device slot and checks out the model; returns None when an error was sent
+        def fail(code, reason, message, error_code=None):
+            if openai:
+                self.send_openai_error(code, message, error_code=error_code)
+            else:
+                self.send_error(code, reason, message)
+
+        n_ctx = options.get('num_ctx', DEFAULT_NUM_CTX)
+        seed = options.get('seed', random.randint(0, 2**32 - 1))
+        sampling_params = get_sampling_params(options)
+        candidates_field, num_candidates = get_num_candidates(request_payload, options)
+        priority = self.get_priority(options)
+        context_strategy = options.get('context_strategy', DEFAULT_CONTEXT_STRATEGY)
+        think = request_payload.get('think', None)
+        think_budget = options.get('think_budget', None)
+
+        if priority not in PRIORITY_CLASSES:
+            fail(400, 'Bad Request', f'Invalid priority "{priority}". Must be one of: {", ".join(PRIORITY_CLASSES)}.')
+            return None
+        if context_strategy not in CONTEXT_STRATEGIES:
+            fail(400, 'Bad Request', f'Invalid context_strategy "{context_strategy}". Must be one of: {", ".join(CONTEXT_STRATEGIES)}.')
+            return None
+        if think_budget is not None and (not isinstance(think_budget, int) or think_budget < 0):
+            fail(400, 'Bad Request', 'Invalid "think_budget". Must be a non-negative number of tokens.')
+            return None
+        if isinstance(num_candidates, bool) or not isinstance(num_candidates, int) or not 1 <= num_candidates <= MAX_CANDIDATES:
+            fail(400, 'Bad Request', f'Invalid "{candidates_field}". Must be an integer from 1 to {MAX_CANDIDATES}.')
+            return None
+
+        # find model
+        with self.trace.span('get_models'):
+            model_info = next((e for e in get_models() if e['name'] == model_name), None)
+        if not model_info:
+            if openai:
+                fail(404, 'Not Found', f'The model "{model_name}" does not exist.', 'model_not_found')
+            else:
+                fail(404, 'Not Found', f'Model "{model_name}" not found.')
+            return None
+
+        # reserve the prompt estimate and the longest answers, capped at the context
+        max_tokens = sampling_params['max_tokens'] or 0
+        if max_tokens <= 0:
+            max_tokens = n_ctx
+        prompt_tokens = int(self.headers.get('Content-Length', 0)) // RATE_LIMIT_CHARS_PER_TOKEN
+        if not self.check_rate_limit(model_name, model_info, min(n_ctx, prompt_tokens + max_tokens * num_candidates), openai):
+            return None
+
+        thinking = model_info.get('thinking', False)
+        if think and not thinking:
+            fail(400, 'Bad Request', f'Model "{model_name}" does not support thinking.')
+            return None
+
+        # after the rate limit, a schema conversion is model work
+        try:
+            grammar, grammar_metrics = get_grammar(response_format)
+        except Exception as e:
+            fail(400, 'Bad Request', f'Invalid "{format_field}": {e}')
+            return None
+
+        # wait for a device slot
+        self.annotate(model=model_name, priority=priority)
+        with self.trace.span('queue', priority=priority):
+            self.ticket = scheduler.acquire(priority)
+
+        token_hook = vkllama_backend.LogitsProcessorList([scheduler.token_hook(self.ticket)])
+        if self.trace.sampled:
+            token_hook.append(self.trace.on_token)
+
+        # init llm
+        with self.trace.span('model_load', model=model_name, n_ctx=n_ctx):
+            self.model = model = model_pool.checkout(model_info, n_ctx, seed)
+        self.ticket.on_pause = lambda: model_pool.suspend(model)
+
+        # whether the answer starts inside a think block
+        think_prompt = ThinkPrompt(model.llm) if thinking else None
+        if think_prompt:
+            token_hook.append(think_prompt)
+
+        # think: false or think_budget
+        think_control = ThinkControl(model.llm, think, think_budget) if thinking and (think is False or think_budget is not None) else None
+        if think_control:
+            token_hook.append(think_control)
+
+        return Generation(
+            self.trace, self.ticket, model, seed, sampling_params, num_candidates, context_strategy,
+            grammar, grammar_metrics, thinking, think_prompt, think_control, token_hook
+        )
+
+    def finish_generation(self):
+        # in the `finally` of the generation routes
+        if self.model:
+            model_pool.checkin(self.model)
+        if self.ticket:
+            scheduler.release(self.ticket)
+            self.annotate_ticket(self.ticket)
+
+    def do_POST(self):
+        self.begin_request()
+        try:
+            if self.url.path == '/api/generate':
+                self.handle_generate()
+            elif self.url.path == '/api/chat':
+                self.handle_chat_completion()
+            elif self.url.path == '/api/session':
+                self.handle_session()
+            elif self.url.path == '/v1/chat/completions':
+                self.handle_openai_completion(chat=True)
+            elif self.url.path == '/v1/completions':
+                self.handle_openai_completion(chat=False)
+            elif self.url.path == '/v1/embeddings':
+                self.handle_openai_embeddings()
+            else:
+                self.send_error(404, 'Not Found')
+        finally:
+            self.finish_request()
 
     def handle_generate(self):
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_payload = json.loads(post_data.decode('utf-8'))
+            with self.trace.span('read_request'):
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request_payload = json.loads(post_data.decode('utf-8'))
 
             # print(f'DEBUG: {request_payload}')
 
@@ -144,40 +2045,14 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
             # options
             options = request_payload.get('options', {})
 
-            n_ctx = options.get('num_ctx', 4096)
-            max_tokens = options.get('num_predict', 4096)
-            temperature = options.get('temperature', 0.8)
-            top_p = options.get('top_p', 0.9)
-            top_k = options.get('top_k', 40)
-            frequency_penalty = options.get('frequency_penalty', 0.0)
-            presence_penalty = options.get('presence_penalty', 0.0)
-            seed = options.get('seed', random.randint(0, 2**32 - 1))
-
             if not prompt:
                 self.send_error(400, 'Bad Request', 'Missing "prompt" in request body.')
                 return
 
-            # find model
-            model_info = next((e for e in get_models() if e['name'] == model_name), None)
-
-            if not model_info:
-                self.send_error(404, 'Not Found', f'Model "{model_name}" not found.')
+            gen = self.start_generation(request_payload, options, model_name, request_payload.get('format'))
+            if not gen:
                 return
-
-            expanded_models_path = os.path.expanduser(models_path)
-            model_path = os.path.join(expanded_models_path, model_info['filename'])
-            thinking = model_info.get('thinking', False)
-
-            # init llm
-            llm = llama_cpp.Llama(
-                model_path=model_path,
-                n_gpu_layers=-1,
-                n_ctx=n_ctx,
-                seed=seed,
-                verbose=False
-            )
-
-            print(f'RAM: {get_memory_usage()} mb.')
+            num_candidates = gen.num_candidates
 
             # create messages
             messages = []
@@ -185,124 +2060,148 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
                 messages.append({'role': 'system', 'content': system_prompt})
             messages.append({'role': 'user', 'content': prompt})
 
+            context = ContextWindow(gen.llm, gen.context_strategy)
+            messages = context.fit(messages, gen.sampling_params['max_tokens'])
+
             # generate
+            # candidates are decoded one after another on the same llm, so every
+            # candidate after the first one reuses the evaluated prompt from the kv cache
+            # (llama.cpp matches the longest common token prefix) and only decodes its answer
             if stream:
                 self.send_response(200)
                 self.send_header('Content-type', 'application/x-ndjson') # Ollama uses ndjson for streaming
                 self.end_headers()
 
-                out = llm.create_chat_completion(
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    top_k=top_k,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    temperature=temperature,
-                    stream=True,
-                )
-
-                think = True
-                for chunk in out:
-                    # streaming
-                    msg = chunk['choices'][0]['delta'].get('content', '')
-
-                    if thinking:
-                        if not think:
+                for index in range(num_candidates):
+                    out = context.generate(messages=messages, **gen.begin_candidate(index))
+
+                    splitter = gen.new_splitter()
+                    for chunk in out:
+                        # streaming
+                        msg = chunk['choices'][0]['delta'].get('content', '')
+                        finish_reason = chunk['choices'][0].get('finish_reason')
+
+                        if splitter:
+                            think_content, response_content = splitter.feed(msg)
+                            if finish_reason is not None:
+                                rest_think, rest_response = splitter.flush()
+                                think_content += rest_think
+                                response_content += rest_response
+
+                            # only tags
+                            if not think_content and not response_content and finish_reason is None:
+                                continue
+                            think_content = think_content or None
+                        else:
                             think_content = None
                             response_content = msg
-                        else:
-                            response_content = ''
-                            think_content = msg
 
-                        if msg.strip() == '<think>':
-                            think = True
-                            continue
-                        elif msg.strip() == '</think>':
-                            think = False
-                            continue
-                    else:
-                        think_content = None
-                        response_content = msg
+                        ollama_chunk = {
+                            'model': model_name,
+                            'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                            'response': response_content,
+                            'thinking': think_content,
+                            'done': False
+                        }
+
+                        if num_candidates > 1:
+                            ollama_chunk['candidate'] = index
+
+                        # last chunk
+                        if finish_reason is not None:
+                            gen.end_candidate(finish_reason)
+                            # only the last candidate finishes the stream
+                            ollama_chunk['done'] = index == num_candidates - 1
+                            ollama_chunk['done_reason'] = finish_reason
+                            ollama_chunk['total_duration'] = 0 # dumb
+                            ollama_chunk['load_duration'] = 0 # dumb
+                            # answer tokens of the candidates so far
+                            ollama_chunk['prompt_eval_count'] = context.report['prompt_tokens']
+                            ollama_chunk['eval_count'] = gen.ticket.generated
+                            ollama_chunk.update(gen.grammar_metrics)
+                            ollama_chunk['context'] = context.report
+
+                        self.write(json.dumps(ollama_chunk).encode('utf-8') + b'\n')
+                        # wfile.flush()
+                self.wfile.flush() # send last chunk
 
-                    ollama_chunk = {
-                        'model': model_name,
-                        'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
-                        'response': response_content,
-                        'thinking': think_content,
-                        'done': False
-                    }
+            else:
+                candidates = []
+                prompt_eval_count = 0
+                eval_count = 0
 
-                    # last chunk
-                    if chunk['choices'][0].get('finish_reason') is not None:
-                        ollama_chunk['done'] = True
-                        ollama_chunk['total_duration'] = 0 # dumb
-                        ollama_chunk['load_duration'] = 0 # dumb
-                        ollama_chunk['prompt_eval_count'] = 0 # dumb
-                        ollama_chunk['eval_count'] = 0 # dumb
+                for index in range(num_candidates):
+                    out = context.complete(messages=messages, **gen.begin_candidate(index))
+                    gen.end_candidate(out['choices'][0].get('finish_reason'))
 
-                    self.wfile.write(json.dumps(ollama_chunk).encode('utf-8') + b'\n')
-                    # wfile.flush()
-                self.wfile.flush() # send last chunk
+                    if gen.thinking:
+                        think_content, response_content = gen.split_thinking(out['choices'][0]['message']['content'])
+                    else:
+                        think_content = None
+                        response_content = out['choices'][0]['message']['content'].strip()
 
-            else:
-                out = llm.create_chat_completion(
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    top_k=top_k,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    temperature=temperature,
-                    stream=False,
-                )
-
-                if thinking:
-                    think, answer = out['choices'][0]['message']['content'].split('</think>')
-
-                    think_content = think.replace('<think>', '').strip()
-                    response_content = answer.strip()
-                else:
-                    think_content = None
-                    response_content = out['choices'][0]['message']['content'].strip()
+                    usage = out.get('usage', {})
+                    if index == 0:
+                        prompt_eval_count = usage.get('prompt_tokens', 0)
+                    eval_count += usage.get('completion_tokens', 0)
+
+                    candidates.append({
+                        'index': index,
+                        'thinking': think_content,
+                        'response': response_content,
+                        'done_reason': out['choices'][0].get('finish_reason', 'stop')
+                    })
 
                 ollama_response = {
                     'model': model_name,
                     'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
-                    'thinking': think_content,
-                    'response': response_content,
+                    'thinking': candidates[0]['thinking'],
+                    'response': candidates[0]['response'],
                     'done': True,
+                    'done_reason': candidates[0]['done_reason'],
                     'total_duration': 0, # dumb
                     'load_duration': 0,
-                    'prompt_eval_count': 0,
-                    'eval_count': 0
+                    'prompt_eval_count': prompt_eval_count,
+                    'eval_count': eval_count
                 }
 
+                if num_candidates > 1:
+                    ollama_response['candidates'] = candidates
+                ollama_response.update(gen.grammar_metrics)
+                ollama_response['context'] = context.report
+
                 self.send_response(200)
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
-                self.wfile.write(json.dumps(ollama_response).encode('utf-8'))
+                with self.trace.span('write'):
+                    self.write(json.dumps(ollama_response).encode('utf-8'))
+
+            self.annotate(prompt_eval_count=context.report['prompt_tokens'])
 
         except json.JSONDecodeError:
             self.send_error(400, 'Bad Request', 'Invalid JSON payload.')
         except KeyError as e:
             self.send_error(400, 'Bad Request', f'Missing key in request: {e}')
         except Exception as e:
-            print(f'Error handling /api/generate: {e}')
+            error_logger.exception(f'{self.trace.request_id} error handling /api/generate: {e}')
             self.send_error(500, 'Internal Server Error', f'An error occurred: {e}')
+        finally:
+            self.finish_generation()
 
     # handle_chat_completion method
     def handle_chat_completion(self):
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            request_payload = json.loads(post_data.decode('utf-8'))
+            with self.trace.span('read_request'):
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request_payload = json.loads(post_data.decode('utf-8'))
 
             # print(f'DEBUG: {request_payload}')
 
             model_name = fix_model_name(request_payload.get('model', DEFAULT_MODEL))
             messages = request_payload.get('messages')
             stream = request_payload.get('stream', True) # Ollama's default for chat API is stream=True
+            session = request_payload.get('session', None)
 
             if not messages:
                 self.send_error(400, 'Bad Request', 'Missing "messages" in request body.')
@@ -310,172 +2209,546 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
             if not isinstance(messages, list) or not all(isinstance(m, dict) and 'role' in m and 'content' in m for m in messages):
                 self.send_error(400, 'Bad Request', 'Invalid "messages" format. Must be a list of objects with "role" and "content".')
                 return
+            if session is not None and not SESSION_ID_PATTERN.match(str(session)):
+                self.send_error(400, 'Bad Request', 'Invalid "session". Use up to 128 letters, digits, "_" or "-".')
+                return
 
             options = request_payload.get('options', {})
-            n_ctx = options.get('num_ctx', 4096)
-            max_tokens = options.get('num_predict', 4096)
-            temperature = options.get('temperature', 0.8)
-            top_p = options.get('top_p', 0.9)
-            top_k = options.get('top_k', 40)
-            frequency_penalty = options.get('frequency_penalty', 0.0)
-            presence_penalty = options.get('presence_penalty', 0.0)
-            seed = options.get('seed', random.randint(0, 2**32 - 1))
 
-            model_info = next((e for e in get_models() if e['name'] == model_name), None)
-            if not model_info:
-                self.send_error(404, 'Not Found', f'Model "{model_name}" not found.')
+            gen = self.start_generation(request_payload, options, model_name, request_payload.get('format'))
+            if not gen:
                 return
+            num_candidates = gen.num_candidates
+            model = gen.model
+            llm = gen.llm
 
-            expanded_models_path = os.path.expanduser(models_path)
-            model_path = os.path.join(expanded_models_path, model_info['filename'])
-            thinking = model_info.get('thinking', False)
-
-            llm = llama_cpp.Llama(
-                model_path=model_path,
-                n_gpu_layers=-1,
-                n_ctx=n_ctx,
-                seed=seed,
-                verbose=False
-            )
+            # restore a loaded session snapshot, unless the llm still holds the session
+            state = session_store.take_state(session, model) if session else None
+            if state is not None:
+                state_tokens = backend.get_state_tokens(state)
+                if backend.get_tokens(llm)[:len(state_tokens)] != state_tokens:
+                    backend.load_state(llm, state)
 
-            print(f'RAM: {get_memory_usage()} mb.')
+            context = ContextWindow(llm, gen.context_strategy)
+            messages = context.fit(messages, gen.sampling_params['max_tokens'])
 
+            # candidates share the evaluated prompt through the kv cache prefix (see handle_generate)
             if stream:
                 self.send_response(200)
                 self.send_header('Content-type', 'application/x-ndjson')
                 self.end_headers()
 
-                response_generator = llm.create_chat_completion(
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    top_k=top_k,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    temperature=temperature,
-                    stream=True,
-                )
-
-                think = True
-                final_finish_reason = None
-
-                for chunk in response_generator:
-                    delta = chunk['choices'][0]['delta']
-                    message_content = delta.get('content', '')
-                    current_finish_reason = chunk['choices'][0].get('finish_reason')
-
-                    if thinking:
-                        if not think:
+                for index in range(num_candidates):
+                    response_generator = context.generate(messages=messages, **gen.begin_candidate(index))
+
+                    splitter = gen.new_splitter()
+                    final_finish_reason = None
+
+                    for chunk in response_generator:
+                        delta = chunk['choices'][0]['delta']
+                        message_content = delta.get('content', '')
+                        current_finish_reason = chunk['choices'][0].get('finish_reason')
+
+                        if current_finish_reason:
+                            # Store the reason for the final chunk
+                            final_finish_reason = current_finish_reason
+
+                        if splitter:
+                            think_content, response_content = splitter.feed(message_content)
+                            if current_finish_reason:
+                                rest_think, rest_response = splitter.flush()
+                                think_content += rest_think
+                                response_content += rest_response
+
+                            # only tags
+                            if not think_content and not response_content:
+                                continue
+                            think_content = think_content or None
+                        else:
                             think_content = None
                             response_content = message_content
-                        else:
-                            response_content = ''
-                            think_content = message_content
 
-                        if message_content.strip() == '<think>':
-                            think = True
-                            continue
-                        elif message_content.strip() == '</think>':
-                            think = False
-                            continue
-                    else:
-                        think_content = None
-                        response_content = message_content
+                        ollama_chunk = {
+                            'model': model_name,
+                            'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
+                            'message': {
+                                'role': 'assistant',
+                                'content': response_content,
+                                'thinking': think_content
+                            },
+                            'done': False
+                        }
+
+                        if num_candidates > 1:
+                            ollama_chunk['candidate'] = index
 
-                    ollama_chunk = {
+                        self.write(json.dumps(ollama_chunk).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+
+                    gen.end_candidate(final_finish_reason)
+
+                    # Construct the final 'done: true' chunk with metrics.
+                    # Only the last candidate finishes the stream, the others just report their reason.
+                    final_ollama_chunk = {
                         'model': model_name,
                         'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
                         'message': {
                             'role': 'assistant',
-                            'content': response_content,
-                            'thinking': think_content
+                            'content': '' # As per Ollama example, content is empty in final metrics chunk
                         },
-                        'done': False
+                        'done': index == num_candidates - 1,
+                        'done_reason': final_finish_reason if final_finish_reason else 'stop', # Default to 'stop' if no specific reason
+                        'total_duration': 0, # Dummy
+                        'load_duration': 0,  # Dummy
+                        'prompt_eval_count': context.report['prompt_tokens'],
+                        'prompt_eval_duration': 0, # Dummy
+                        'eval_count': gen.ticket.generated, # answer tokens of the candidates so far
+                        'eval_duration': 0 # Dummy
                     }
-                    
-                    self.wfile.write(json.dumps(ollama_chunk).encode('utf-8') + b'\n')
-                    self.wfile.flush()
 
-                    if current_finish_reason:
-                        # Store the reason for the final chunk
-                        final_finish_reason = current_finish_reason
+                    if num_candidates > 1:
+                        final_ollama_chunk['candidate'] = index
+                    final_ollama_chunk.update(gen.grammar_metrics)
+                    final_ollama_chunk['context'] = context.report
 
-                # Construct the final 'done: true' chunk with metrics.
-                final_ollama_chunk = {
-                    'model': model_name,
-                    'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
-                    'message': {
-                        'role': 'assistant',
-                        'content': '' # As per Ollama example, content is empty in final metrics chunk
-                    },
-                    'done': True,
-                    'done_reason': final_finish_reason if final_finish_reason else 'stop', # Default to 'stop' if no specific reason
-                    'total_duration': 0, # Dummy
-                    'load_duration': 0,  # Dummy
-                    'prompt_eval_count': 0, # Dummy
-                    'prompt_eval_duration': 0, # Dummy
-                    'eval_count': 0, # Dummy
-                    'eval_duration': 0 # Dummy
-                }
-                self.wfile.write(json.dumps(final_ollama_chunk).encode('utf-8') + b'\n')
-                self.wfile.flush()
+                    self.write(json.dumps(final_ollama_chunk).encode('utf-8') + b'\n')
+                    self.wfile.flush()
 
             else: # Not streaming
-                full_completion = llm.create_chat_completion(
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    top_p=top_p,
-                    top_k=top_k,
-                    frequency_penalty=frequency_penalty,
-                    presence_penalty=presence_penalty,
-                    temperature=temperature,
-                    stream=False,
-                )
-
-                response_message = full_completion['choices'][0]['message']
-                usage = full_completion['usage']
-                finish_reason = full_completion['choices'][0].get('finish_reason', 'stop')
-
-                if thinking:
-                    think, answer = response_message['content'].split('</think>')
-
-                    think_content = think.replace('<think>', '').strip()
-                    response_content = answer.strip()
-                else:
-                    think_content = None
-                    response_content = response_message['content'].strip()
+                candidates = []
+                prompt_eval_count = 0
+                eval_count = 0
+
+                for index in range(num_candidates):
+                    full_completion = context.complete(messages=messages, **gen.begin_candidate(index))
+                    gen.end_candidate(full_completion['choices'][0].get('finish_reason'))
+
+                    response_message = full_completion['choices'][0]['message']
+                    usage = full_completion['usage']
+                    finish_reason = full_completion['choices'][0].get('finish_reason', 'stop')
+
+                    if gen.thinking:
+                        think_content, response_content = gen.split_thinking(response_message['content'])
+                    else:
+                        think_content = None
+                        response_content = response_message['content'].strip()
+
+                    # the prompt is evaluated once for all candidates
+                    if index == 0:
+                        prompt_eval_count = usage.get('prompt_tokens', 0)
+                    eval_count += usage.get('completion_tokens', 0)
+
+                    candidates.append({
+                        'index': index,
+                        'message': {
+                            'role': response_message['role'],
+                            'content': response_content,
+                            'thinking': think_content
+                        },
+                        'done_reason': finish_reason
+                    })
 
                 ollama_response = {
                     'model': model_name,
                     'created_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z',
-                    'message': {
-                        'role': response_message['role'],
-                        'content': response_content,
-                        'thinking': think_content
-                    },
+                    'message': candidates[0]['message'],
                     'done': True,
-                    'done_reason': finish_reason,
+                    'done_reason': candidates[0]['done_reason'],
                     'total_duration': 0, # Dummy
                     'load_duration': 0,  # Dummy
-                    'prompt_eval_count': usage.get('prompt_tokens', 0),
+                    'prompt_eval_count': prompt_eval_count,
                     'prompt_eval_duration': 0, # Dummy
-                    'eval_count': usage.get('completion_tokens', 0),
+                    'eval_count': eval_count,
                     'eval_duration': 0 # Dummy
                 }
 
+                if num_candidates > 1:
+                    ollama_response['candidates'] = candidates
+                ollama_response.update(gen.grammar_metrics)
+                ollama_response['context'] = context.report
+
                 self.send_response(200)
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
-                self.wfile.write(json.dumps(ollama_response).encode('utf-8'))
+                with self.trace.span('write'):
+                    self.write(json.dumps(ollama_response).encode('utf-8'))
+
+            self.annotate(prompt_eval_count=context.report['prompt_tokens'])
+
+            # remember what the session left in the kv cache
+            if session:
+                session_store.update(session, model)
 
         except json.JSONDecodeError:
             self.send_error(400, 'Bad Request', 'Invalid JSON payload.')
         except KeyError as e:
             self.send_error(400, 'Bad Request', f'Missing key in request: {e}')
         except Exception as e:
-            print(f'Error handling /api/chat: {e}')
+            error_logger.exception(f'{self.trace.request_id} error handling /api/chat: {e}')
+            self.send_error(500, 'Internal Server Error', f'An error occurred: {e}')
+        finally:
+            self.finish_generation()
+
+    def handle_session(self):
+        ticket = None
+        model = None
+        try:
+            with self.trace.span('read_request'):
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request_payload = json.loads(post_data.decode('utf-8'))
+
+            session = request_payload.get('session')
+            action = request_payload.get('action')
+
+            if not session or not SESSION_ID_PATTERN.match(str(session)):
+                self.send_error(400, 'Bad Request', 'Missing or invalid "session".')
+                return
+            if action not in ('save', 'load'):
+                self.send_error(400, 'Bad Request', 'Invalid "action". Must be "save" or "load".')
+                return
+
+            start = time.perf_counter_ns()
+
+            if action == 'save':
+                record = session_store.get(session)
+                if not record:
+                    self.send_error(404, 'Not Found', f'Session "{session}" not found.')
+                    return
+
+                model_info = next((e for e in get_models() if fix_model_name(e['name']) == record['model']), None)
+                if not model_info:
+                    self.send_error(404, 'Not Found', f'Model "{record["model"]}" not found.')
+                    return
+
+                ticket = scheduler.acquire(self.get_priority(request_payload.get('options', {})))
+                model = model_pool.checkout(model_info, record['n_ctx'], random.randint(0, 2**32 - 1))
+
+                header = session_store.save(session, model, record['tokens'])
+            else:
+                try:
+                    header = session_store.load(session)
+                except FileNotFoundError:
+                    self.send_error(404, 'Not Found', f'Session "{session}" snapshot not found.')
+                    return
+
+                # a snapshot is only valid for the same model file and context size
+                model_info = next((e for e in get_models() if fix_model_name(e['name']) == header['model']), None)
+                options = request_payload.get('options', {})
+                expected_model = fix_model_name(request_payload.get('model', header['model']))
+                expected_n_ctx = options.get('num_ctx', header['n_ctx'])
+
+                if model_info and header['fingerprint'] != get_model_fingerprint(model_info):
+                    # the model file changed, the snapshot can't be used anymore
+                    session_store.discard(session)
+                    self.send_error(409, 'Conflict', f'Session "{session}" snapshot is outdated (model file changed) and was removed.')
+                    return
+                if not model_info or header['model'] != expected_model or header['n_ctx'] != expected_n_ctx:
+                    # the snapshot is fine, the request asks for another model or context, keep the file
+                    session_store.discard(session, remove_file=False)
+                    self.send_error(409, 'Conflict', f'Session "{session}" snapshot is for model "{header["model"]}" with num_ctx {header["n_ctx"]}.')
+                    return
+
+            response_payload = {
+                'session': session,
+                'action': action,
+                'model': header['model'],
+                'n_ctx': header['n_ctx'],
+                'n_tokens': header['n_tokens'],
+                'size': header.get('size', None),
+                'compression': header['compression'],
+                'duration': time.perf_counter_ns() - start
+            }
+
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.write(json.dumps(response_payload).encode('utf-8'))
+
+        except json.JSONDecodeError:
+            self.send_error(400, 'Bad Request', 'Invalid JSON payload.')
+        except Exception as e:
+            error_logger.exception(f'{self.trace.request_id} error handling /api/session: {e}')
             self.send_error(500, 'Internal Server Error', f'An error occurred: {e}')
+        finally:
+            if model:
+                model_pool.checkin(model)
+            if ticket:
+                scheduler.release(ticket)
+                self.annotate_ticket(ticket)
+
+    # OpenAI compatible api
+    # https://platform.openai.com/docs/api-reference
+    def send_openai_error(self, code, message, error_type='invalid_request_error', error_code=None):
+        body = json.dumps({'error': {'message': message, 'type': error_type, 'param': None, 'code': error_code}}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.write(body)
+
+    def handle_openai_models(self):
+        try:
+            expanded_models_path = os.path.expanduser(models_path)
+            data = []
+            for model_info in get_models():
+                try:
+                    base_info, _ = get_base_model(model_info)
+                except ValueError as e:
+                    error_logger.error(str(e))
+                    continue
+                full_model_path = os.path.join(expanded_models_path, base_info['filename'])
+                created = int(os.path.getmtime(full_model_path)) if os.path.exists(full_model_path) else 0
+                data.append({
+                    'id': fix_model_name(model_info['name']),
+                    'object': 'model',
+                    'created': created,
+                    'owned_by': 'vkllama'
+                })
+
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.write(json.dumps({'object': 'list', 'data': data}).encode('utf-8'))
+
+        except Exception as e:
+            error_logger.exception(f'{self.trace.request_id} error handling /v1/models: {e}')
+            self.send_openai_error(500, f'An error occurred: {e}', 'server_error')
+
+    def handle_openai_completion(self, chat):
+        try:
+            with self.trace.span('read_request'):
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request_payload = json.loads(post_data.decode('utf-8'))
+
+            model_name = fix_model_name(request_payload.get('model') or DEFAULT_MODEL)
+            stream = request_payload.get('stream', False)
+            include_usage = stream and (request_payload.get('stream_options') or {}).get('include_usage', False)
+
+            options = get_openai_options(request_payload)
+
+            if chat:
+                messages = request_payload.get('messages')
+                if not messages or not isinstance(messages, list) or not all(isinstance(m, dict) and 'role' in m for m in messages):
+                    self.send_openai_error(400, '"messages" must be a non-empty list of objects with "role" and "content".')
+                    return
+                messages = [{'role': m['role'], 'content': get_message_text(m.get('content'))} for m in messages]
+            else:
+                prompt = request_payload.get('prompt')
+                if isinstance(prompt, list) and len(prompt) == 1:
+                    prompt = prompt[0]
+                if not prompt or not isinstance(prompt, str):
+                    self.send_openai_error(400, '"prompt" must be a non-empty string.')
+                    return
+
+            gen = self.start_generation(
+                request_payload, options, model_name,
+                get_openai_format(request_payload.get('response_format')), 'response_format', openai=True
+            )
+            if not gen:
+                return
+            if request_payload.get('stop'):
+                gen.sampling_params['stop'] = request_payload['stop']
+
+            # raw completions are passed through, only chat messages can be fitted
+            context = ContextWindow(gen.llm, gen.context_strategy if chat else 'none')
+            if chat:
+                messages = context.fit(messages, gen.sampling_params['max_tokens'])
+                # thinking is returned separately as `reasoning_content`
+                split = gen.thinking
+            else:
+                split = False
+
+            envelope = {
+                'id': f'{"chatcmpl" if chat else "cmpl"}-{self.trace.request_id}',
+                'object': 'chat.completion' if chat else 'text_completion',
+                'created': int(time.time()),
+                'model': model_name
+            }
+
+            if stream:
+                self.send_response(200)
+                self.send_header('Content-type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+
+                if chat:
+                    envelope['object'] = 'chat.completion.chunk'
+                prefix = get_sse_prefix(envelope)
+
+                for index in range(gen.num_candidates):
+                    params = gen.begin_candidate(index)
+                    out = context.generate(messages=messages, **params) if chat else context.generate_text(prompt, **params)
+
+                    if chat:
+                        first = [{'index': index, 'delta': {'role': 'assistant', 'content': ''}, 'logprobs': None, 'finish_reason': None}]
+                        self.write(prefix + json.dumps(first).encode('utf-8') + b'}\n\n')
+
+                    splitter = gen.new_splitter() if split else None
+                    for chunk in out:
+                        piece = chunk['choices'][0]['delta'].get('content', '')
+                        finish_reason = chunk['choices'][0].get('finish_reason')
+
+                        think_content = None
+                        if splitter:
+                            think_content, piece = splitter.feed(piece)
+                            if finish_reason is not None:
+                                rest_think, rest_piece = splitter.flush()
+                                think_content += rest_think
+                                piece += rest_piece
+
+                        if not think_content and not piece and finish_reason is None:
+                            continue
+
+                        if chat:
+                            delta = {}
+                            if think_content:
+                                delta['reasoning_content'] = think_content
+                            if piece:
+                                delta['content'] = piece
+                            choices = [{'index': index, 'delta': delta, 'logprobs': None, 'finish_reason': finish_reason}]
+                        else:
+                            choices = [{'index': index, 'text': piece, 'logprobs': None, 'finish_reason': finish_reason}]
+
+                        self.write(prefix + json.dumps(choices).encode('utf-8') + b'}\n\n')
+
+                    gen.end_candidate(finish_reason)
+
+                if include_usage:
+                    # chunks can hold several tokens or none, the ticket counts the sampled ones
+                    usage = {
+                        'prompt_tokens': context.report['prompt_tokens'],
+                        'completion_tokens': gen.ticket.generated,
+                        'total_tokens': context.report['prompt_tokens'] + gen.ticket.generated
+                    }
+                    self.write(prefix + b'[], "usage": ' + json.dumps(usage).encode('utf-8') + b'}\n\n')
+                self.write(b'data: [DONE]\n\n')
+                self.wfile.flush()
+
+            else:
+                choices = []
+
+                for index in range(gen.num_candidates):
+                    params = gen.begin_candidate(index)
+                    out = context.complete(messages=messages, **params) if chat else context.complete_text(prompt, **params)
+                    gen.end_candidate(out['choices'][0].get('finish_reason'))
+
+                    finish_reason = out['choices'][0].get('finish_reason') or 'stop'
+
+                    if chat:
+                        content = out['choices'][0]['message']['content']
+                        think_content, content = gen.split_thinking(content) if split else (None, content)
+                        message = {'role': 'assistant', 'content': content}
+                        if think_content:
+                            message['reasoning_content'] = think_content
+                        choices.append({'index': index, 'message': message, 'logprobs': None, 'finish_reason': finish_reason})
+                    else:
+                        choices.append({'index': index, 'text': out['choices'][0]['text'], 'logprobs': None, 'finish_reason': finish_reason})
+
+                response_payload = dict(envelope, choices=choices, usage={
+                    'prompt_tokens': context.report['prompt_tokens'],
+                    'completion_tokens': gen.ticket.generated,
+                    'total_tokens': context.report['prompt_tokens'] + gen.ticket.generated
+                })
+
+                self.send_response(200)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                with self.trace.span('write'):
+                    self.write(json.dumps(response_payload).encode('utf-8'))
+
+            self.annotate(prompt_eval_count=context.report['prompt_tokens'])
+
+        except json.JSONDecodeError:
+            self.send_openai_error(400, 'Invalid JSON payload.')
+        except Exception as e:
+            error_logger.exception(f'{self.trace.request_id} error handling {self.url.path}: {e}')
+            self.send_openai_error(500, f'An error occurred: {e}', 'server_error')
+        finally:
+            self.finish_generation()
+
+    def handle_openai_embeddings(self):
+        ticket = None
+        model = None
+        try:
+            with self.trace.span('read_request'):
+                content_length = int(self.headers['Content-Length'])
+                post_data = self.rfile.read(content_length)
+                request_payload = json.loads(post_data.decode('utf-8'))
+
+            model_name = fix_model_name(request_payload.get('model') or DEFAULT_MODEL)
+            inputs = request_payload.get('input')
+            encoding_format = request_payload.get('encoding_format', 'float')
+            options = request_payload.get('options') or {}
+            n_ctx = options.get('num_ctx', DEFAULT_NUM_CTX)
+            priority = self.get_priority(options)
+
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            if not inputs or not isinstance(inputs, list) or not all(isinstance(i, str) for i in inputs):
+                self.send_openai_error(400, '"input" must be a string or a list of strings.')
+                return
+            if encoding_format not in ('float', 'base64'):
+                self.send_openai_error(400, 'Invalid "encoding_format". Must be "float" or "base64".')
+                return
+            if priority not in PRIORITY_CLASSES:
+                self.send_openai_error(400, f'Invalid priority "{priority}". Must be one of: {", ".join(PRIORITY_CLASSES)}.')
+                return
+
+            with self.trace.span('get_models'):
+                model_info = next((e for e in get_models() if e['name'] == model_name), None)
+            if not model_info:
+                self.send_openai_error(404, f'The model "{model_name}" does not exist.', error_code='model_not_found')
+                return
+
+            # only input tokens, estimated from the body
+            if not self.check_rate_limit(model_name, model_info, content_length // RATE_LIMIT_CHARS_PER_TOKEN, openai=True):
+                return
+
+            self.annotate(model=model_name, priority=priority)
+            with self.trace.span('queue', priority=priority):
+                ticket = scheduler.acquire(priority)
+
+            # llama.cpp needs a separate context with embeddings enabled
+            with self.trace.span('model_load', model=model_name, n_ctx=n_ctx):
+                model = model_pool.checkout(model_info, n_ctx, random.randint(0, 2**32 - 1), embedding=True)
+
+            with self.trace.span('embed', inputs=len(inputs)):
+                out = backend.embed(model.llm, inputs)
+
+            data = []
+            for index, item in enumerate(out['data']):
+                embedding = item['embedding']
+                if encoding_format == 'base64':
+                    embedding = base64.b64encode(np.asarray(embedding, dtype='<f4').tobytes()).decode('ascii')
+                data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+
+            prompt_tokens = out.get('usage', {}).get('prompt_tokens', 0)
+            response_payload = {
+                'object': 'list',
+                'data': data,
+                'model': model_name,
+                'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens}
+            }
+            self.annotate(prompt_eval_count=prompt_tokens)
 
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.write(json.dumps(response_payload).encode('utf-8'))
+
+        except json.JSONDecodeError:
+            self.send_openai_error(400, 'Invalid JSON payload.')
+        except Exception as e:
+            error_logger.exception(f'{self.trace.request_id} error handling /v1/embeddings: {e}')
+            self.send_openai_error(500, f'An error occurred: {e}', 'server_error')
+        finally:
+            if model:
+                model_pool.checkin(model)
+            if ticket:
+                scheduler.release(ticket)
+                self.annotate_ticket(ticket)
 
     def log_message(self, format, *args):
         # print(f'[{self.log_date_time_string()}] {self.address_string()} - {format % args}')
@@ -485,18 +2758,101 @@ class VKLlamaRequestHandler(http.server.BaseHTTPRequestHandler):
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     daemon_threads = True
 
+    def __init__(self, server_address, handler_class, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.active = 0
+        self.active_cond = threading.Condition()
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        # a new instance can bind the same port and take over while this one drains
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        # counted before the thread starts, so a drain can't miss a just accepted request
+        with self.active_cond:
+            self.active += 1
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.active_cond:
+                self.active -= 1
+                self.active_cond.notify_all()
+
+    def wait_idle(self, timeout):
+        with self.active_cond:
+            return self.active_cond.wait_for(lambda: self.active == 0, timeout)
+
+
+def preload_models(names):
+    # `name` or `name@num_ctx`, loaded before the port is bound
+    for entry in names:
+        name, _, n_ctx = entry.partition('@')
+        model_name = fix_model_name(name)
+        model_info = next((e for e in get_models() if e['name'] == model_name), None)
+        if not model_info:
+            print(f'Warning: Model "{model_name}" not found, skipping preload.')
+            continue
+
+        model = model_pool.checkout(model_info, int(n_ctx) if n_ctx else DEFAULT_NUM_CTX, random.randint(0, 2**32 - 1))
+        model_pool.checkin(model)
+        print(f'Preloaded {model_name} in {model.load_duration / 1e9:.1f} s.')
+
+    if len(names) > model_pool.max_loaded:
+        print(f'Warning: {len(names)} models preloaded, but only {model_pool.max_loaded} are kept loaded (--max-loaded).')
+
 
 def serve(args):
-    global models_path
+    global models_path, backend
     models_path = args.models
+    if args.backend == 'stub':
+        backend = vkllama_backend.StubBackend(args.stub_rate, args.stub_prompt_rate, args.stub_tokens, args.stub_load_time)
+    scheduler.slots = args.parallel
+    model_pool.max_loaded = args.max_loaded
+    session_store.path = args.sessions
+    session_store.compression = args.sessions_compression
+    tracer.path = os.path.expanduser(args.trace_file) if args.trace_file else None
+    tracer.sample_rate = args.trace_sample
+    tracer.format = args.trace_format
+    rate_limiter.default_limits = {'requests_per_second': args.limit_rps, 'tokens_per_minute': args.limit_tpm}
+    log_listener = start_logging(args.access_log, args.log_max_bytes, args.log_backups, args.error_log)
+
+    if args.preload:
+        preload_models(args.preload)
 
     server_address = (args.host, args.port)
-    httpd = ThreadedHTTPServer(server_address, VKLlamaRequestHandler)
-    print(f'Starting vkllama server on http://{args.host}:{args.port}')
+    httpd = ThreadedHTTPServer(server_address, VKLlamaRequestHandler, reuse_port=args.reuse_port)
+
+    # handlers run in the main thread, which is busy in serve_forever
+    def on_sigterm(signum, frame):
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    def on_sighup(signum, frame):
+        threading.Thread(target=reload_models, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, on_sighup)
+
+    print(f'Starting vkllama server on http://{args.host}:{args.port} ({backend.name} backend)')
 
     try:
         httpd.serve_forever()
+
+        # SIGTERM: stop accepting, let in-flight requests finish
+        httpd.server_close()
+        print(f'Draining {httpd.active} requests...')
+        if not httpd.wait_idle(args.drain_timeout):
+            print(f'Drain timeout, {httpd.active} requests aborted.')
+        print('Server is shut down.')
     except KeyboardInterrupt:
         print('\nServer is shutting down.')
         httpd.shutdown()
         httpd.server_close()
+    finally:
+        log_listener.stop()
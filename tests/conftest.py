@@ -0,0 +1,94 @@
+import collections
+import json
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import vkllama_backend
+import vkllama_serve
+
+
+@pytest.fixture
+def stub_backend(monkeypatch):
+    # fast stub, no model files or GPU needed
+    backend = vkllama_backend.StubBackend(rate=10000.0, prompt_rate=1000000.0)
+    monkeypatch.setattr(vkllama_serve, 'backend', backend)
+    return backend
+
+
+@pytest.fixture
+def stub_model(stub_backend):
+    def load(n_ctx=512, seed=7, **model_info):
+        model_info = dict({'name': 'stub', 'filename': 'stub.gguf', 'digest': 'stub'}, **model_info)
+        llm = stub_backend.load('stub.gguf', model_info, n_ctx, seed)
+        return vkllama_serve.LoadedModel(model_info, model_info, n_ctx, llm, 0.0)
+    return load
+
+
+STUB_MODELS = [
+    {'name': 's:latest', 'filename': 's.gguf', 'thinking': True},
+    {'name': 'q:latest', 'filename': 'q.gguf'}
+]
+
+
+class Client:
+    # tiny HTTP client for the in-process server
+    def __init__(self, url):
+        self.url = url
+
+    def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers=dict(headers or {}))
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def get(self, path, **kw):
+        return self.request('GET', path, **kw)
+
+    def post(self, path, body, **kw):
+        return self.request('POST', path, body, **kw)
+
+    def json(self, method, path, body=None, **kw):
+        status, headers, data = self.request(method, path, body, **kw)
+        return status, json.loads(data)
+
+
+@pytest.fixture
+def models(tmp_path):
+    # models.json of the server, tests may rewrite it
+    path = tmp_path / 'models'
+    path.mkdir()
+    (path / 'models.json').write_text(json.dumps(STUB_MODELS))
+    return path
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path, models, stub_backend):
+    # the server on a free port with fresh global state
+    monkeypatch.setattr(vkllama_serve, 'models_path', str(models))
+    monkeypatch.setattr(vkllama_serve, 'models_config', None)
+    monkeypatch.setattr(vkllama_serve, 'models_stamp', None)
+    monkeypatch.setattr(vkllama_serve, 'model_pool', vkllama_serve.ModelPool())
+    monkeypatch.setattr(vkllama_serve, 'scheduler', vkllama_serve.Scheduler())
+    monkeypatch.setattr(vkllama_serve, 'rate_limiter', vkllama_serve.RateLimiter())
+    monkeypatch.setattr(vkllama_serve, 'session_store', vkllama_serve.SessionStore(str(tmp_path / 'sessions')))
+    monkeypatch.setattr(vkllama_serve, 'grammar_cache', collections.OrderedDict())
+    monkeypatch.setattr(vkllama_serve, 'grammar_cache_stats', {'hits': 0, 'misses': 0})
+
+    httpd = vkllama_serve.ThreadedHTTPServer(('127.0.0.1', 0), vkllama_serve.VKLlamaRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield Client(f'http://127.0.0.1:{httpd.server_address[1]}')
+    httpd.shutdown()
+    httpd.server_close()
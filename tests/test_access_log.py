@@ -0,0 +1,76 @@
+import json
+import logging
+import time
+
+import pytest
+
+import vkllama_serve
+from vkllama_serve import RateLimitFilter
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+    def wait(self, count):
+        # the record is written after the response is sent
+        deadline = time.monotonic() + 5.0
+        while len(self.records) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        assert len(self.records) == count
+        return self.records
+
+
+@pytest.fixture
+def access_log(server, monkeypatch):
+    records = Records()
+    monkeypatch.setattr(vkllama_serve.access_logger, 'handlers', [records])
+    return records
+
+
+def test_generation_record(server, access_log):
+    status, headers, data = server.post('/api/generate', {
+        'model': 'q', 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 6, 'priority': 'low'}
+    })
+    assert status == 200
+    response = json.loads(data)
+
+    record, = access_log.wait(1)
+    assert record['request_id'] == headers['X-Request-Id']
+    assert (record['client'], record['method'], record['route'], record['status']) == ('127.0.0.1', 'POST', '/api/generate', 200)
+    assert (record['model'], record['priority']) == ('q:latest', 'low')
+    assert record['prompt_eval_count'] == response['prompt_eval_count']
+    assert record['eval_count'] == response['eval_count']
+    assert record['preemptions'] == 0
+    assert 0 <= record['queue_wait'] <= record['ttft'] <= record['duration']
+
+
+def test_rejected_request_record(server, access_log):
+    status, headers, data = server.post('/api/generate', {'model': 'missing', 'prompt': 'hi', 'stream': False})
+    assert status == 404
+
+    record, = access_log.wait(1)
+    assert (record['route'], record['status']) == ('/api/generate', 404)
+    # never got a device slot
+    assert 'queue_wait' not in record and 'eval_count' not in record
+
+
+def test_no_records_without_access_log(server, monkeypatch):
+    monkeypatch.setattr(vkllama_serve.access_logger, 'handlers', [])
+    assert server.get('/api/tags')[0] == 200
+
+
+def test_error_log_rate_limit():
+    log_filter = RateLimitFilter(2, 60.0)
+    records = [logging.LogRecord('vkllama.error', logging.ERROR, __file__, 0, f'error {i}', None, None) for i in range(5)]
+    assert [log_filter.filter(record) for record in records] == [True, True, False, False, False]
+
+    # the next allowed record reports the dropped ones
+    log_filter.last -= 30.0
+    record = logging.LogRecord('vkllama.error', logging.ERROR, __file__, 0, 'error 5', None, None)
+    assert log_filter.filter(record)
+    assert record.getMessage() == 'error 5 (3 similar errors suppressed)'
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+
+BASE_SIZE = 1000
+
+LORA_MODELS = [
+    {'name': 'b:latest', 'filename': 'b.gguf'},
+    {'name': 'b-x:latest', 'base': 'b', 'adapters': [{'filename': 'x.gguf'}]},
+    {'name': 'b-y:latest', 'base': 'b', 'adapters': [{'filename': 'y.gguf', 'scale': 0.5}]}
+]
+
+
+@pytest.fixture
+def lora_server(server, models):
+    (models / 'models.json').write_text(json.dumps(LORA_MODELS))
+    (models / 'b.gguf').write_bytes(b'\0' * BASE_SIZE)
+    (models / 'x.gguf').write_bytes(b'\0' * 10)
+    (models / 'y.gguf').write_bytes(b'\0' * 20)
+    return server
+
+
+def generate(server, model):
+    status, payload = server.json('POST', '/api/generate', {
+        'model': model, 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 8, 'seed': 1}
+    })
+    assert status == 200
+    return payload['response']
+
+
+def test_variants_share_one_instance(lora_server):
+    x = generate(lora_server, 'b-x')
+    y = generate(lora_server, 'b-y')
+    assert generate(lora_server, 'b-x') == x
+    # the stub answers like the adapters changed the weights
+    assert x != y
+
+    status, payload = lora_server.json('GET', '/api/ps')
+    assert status == 200
+    assert len(payload['models']) == 1
+    model = payload['models'][0]
+    assert model['name'] == 'b-x:latest'
+    assert model['details']['parent_model'] == 'b:latest'
+    assert model['size'] == BASE_SIZE + 30
+
+    adapters = model['adapters']
+    assert adapters['active'] == [{'filename': 'x.gguf', 'scale': 1.0}]
+    assert sorted(adapters['cached']) == ['x.gguf', 'y.gguf']
+    assert adapters['cached_size'] == 30
+    assert adapters['variants'] == ['b-x:latest', 'b-y:latest']
+    assert adapters['memory_saved'] == BASE_SIZE
+
+    # every request switched, each adapter was loaded once
+    status, metrics = lora_server.json('GET', '/api/metrics')
+    assert metrics['adapters']['switches'] == 3
+    assert metrics['adapters']['loads'] == 2
+    assert metrics['adapters']['memory_saved'] == BASE_SIZE
+
+
+def test_same_variant_does_not_switch(lora_server):
+    generate(lora_server, 'b-x')
+    generate(lora_server, 'b-x')
+    status, metrics = lora_server.json('GET', '/api/metrics')
+    assert (metrics['adapters']['switches'], metrics['adapters']['loads']) == (1, 1)
+
+
+def test_missing_base(lora_server, models):
+    # a broken models.json is an error of the server, not of the request
+    (models / 'models.json').write_text(json.dumps(LORA_MODELS[1:]))
+    status, headers, data = lora_server.post('/api/generate', {'model': 'b-x', 'prompt': 'hi', 'stream': False})
+    assert status == 500
+    assert b'Base model' in data
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+
+def generate(server, **body):
+    return server.post('/api/generate', dict({'model': 'q:latest', 'prompt': 'name a color', 'options': {'num_predict': 8}}, **body))
+
+
+def test_candidates_in_response(server):
+    status, headers, data = generate(server, n=3, stream=False)
+    assert status == 200
+    payload = json.loads(data)
+    assert len(payload['candidates']) == 3
+    # the top-level answer is the first candidate
+    assert payload['response'] == payload['candidates'][0]['response']
+
+
+def test_candidates_streamed_one_after_another(server):
+    status, headers, data = generate(server, n=2, stream=True)
+    assert status == 200
+    chunks = [json.loads(line) for line in data.splitlines() if line]
+    indexes = [chunk['candidate'] for chunk in chunks]
+    assert indexes == sorted(indexes) and set(indexes) == {0, 1}
+    # only the last candidate finishes the stream
+    assert [chunk['done'] for chunk in chunks].count(True) == 1
+    assert chunks[-1]['done'] and chunks[-1]['candidate'] == 1
+
+
+@pytest.mark.parametrize('body', [
+    {'n': 'abc'}, {'n': 1.5}, {'n': 0}, {'n': 17}, {'n': True},
+    {'options': {'num_predict': 8, 'num_candidates': -1}}
+])
+def test_invalid_count(server, body):
+    status, headers, data = generate(server, stream=False, **body)
+    assert status == 400
+    field = 'num_candidates' if 'options' in body else 'n'
+    assert f'"{field}"'.encode('utf-8') in data
+
+
+def test_invalid_count_openai(server):
+    status, payload = server.json('POST', '/v1/chat/completions', {
+        'model': 'q:latest', 'messages': [{'role': 'user', 'content': 'hi'}], 'n': 0
+    })
+    assert status == 400
+    assert '"n"' in payload['error']['message']
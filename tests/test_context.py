@@ -0,0 +1,119 @@
+from vkllama_serve import ContextWindow
+
+
+def turn(index, words=20):
+    return [
+        {'role': 'user', 'content': f'question {index}' + ' lorem' * words},
+        {'role': 'assistant', 'content': f'answer {index}' + ' ipsum' * words}
+    ]
+
+
+def test_fitting_messages_pass_through(stub_model):
+    context = ContextWindow(stub_model(n_ctx=512).llm, 'truncate')
+    messages = [{'role': 'system', 'content': 'be brief'}] + turn(0) + [{'role': 'user', 'content': 'hi'}]
+    assert context.fit(messages, 64) == messages
+    assert context.report['dropped_messages'] == 0
+
+
+def test_none_strategy_never_drops(stub_model):
+    context = ContextWindow(stub_model(n_ctx=128).llm, 'none')
+    messages = turn(0, 200)
+    assert context.fit(messages, 64) is messages
+
+
+def test_truncate_keeps_system_and_last_message(stub_model):
+    context = ContextWindow(stub_model(n_ctx=256).llm, 'truncate')
+    messages = [{'role': 'system', 'content': 'be brief'}]
+    for index in range(10):
+        messages += turn(index)
+    messages.append({'role': 'user', 'content': 'last question'})
+
+    fitted = context.fit(messages, 64)
+    assert fitted[0] == messages[0]
+    assert fitted[-1] == messages[-1]
+    assert fitted[1]['role'] == 'user'
+
+    # answer reserve is min(num_predict, n_ctx / 4)
+    assert sum(context.count_tokens(m) for m in fitted) <= 256 - 64
+    assert context.report['dropped_messages'] == len(messages) - len(fitted)
+    assert context.report['dropped_tokens'] == sum(context.count_tokens(m) for m in messages[1:len(messages) - len(fitted) + 1])
+
+
+def test_truncate_keeps_only_last_message_when_nothing_fits(stub_model):
+    context = ContextWindow(stub_model(n_ctx=256).llm, 'truncate')
+    messages = turn(0) + [{'role': 'user', 'content': 'lorem' + ' lorem' * 300}]
+    assert context.fit(messages, 64) == messages[-1:]
+
+
+def test_truncation_cut_is_stable_across_turns(stub_model):
+    # the first kept message only moves when the window fills up again, so the next
+    # turns share the prompt prefix with the previous one (kv cache reuse)
+    context = ContextWindow(stub_model(n_ctx=512).llm, 'truncate')
+    messages = [{'role': 'system', 'content': 'be brief'}]
+    cuts = []
+    for index in range(40):
+        request = messages + [{'role': 'user', 'content': f'question {index}' + ' lorem' * 20}]
+        fitted = context.fit(request, 128)
+        cuts.append(request.index(fitted[1]))
+        messages = request + [{'role': 'assistant', 'content': f'answer {index}' + ' ipsum' * 20}]
+
+    moves = sum(1 for a, b in zip(cuts, cuts[1:]) if a != b)
+    assert cuts[-1] > 1
+    assert cuts == sorted(cuts)
+    # a block is about half of the budget, several turns
+    assert moves <= len(cuts) // 3
+
+
+def generate(context, max_tokens, **params):
+    # the stub streams one token per chunk
+    pieces = []
+    finish_reason = None
+    for chunk in context.generate([{'role': 'user', 'content': 'hi'}], max_tokens, seed=1, **params):
+        choice = chunk['choices'][0]
+        if choice['delta'].get('content'):
+            pieces.append(choice['delta']['content'])
+        finish_reason = choice['finish_reason'] or finish_reason
+    return pieces, finish_reason
+
+
+def test_shift_stops_at_num_predict(stub_backend, stub_model):
+    stub_backend.tokens = 1000
+    context = ContextWindow(stub_model(n_ctx=512).llm, 'shift')
+    pieces, finish_reason = generate(context, 40)
+    assert finish_reason == 'length'
+    assert len(pieces) == context.completion_tokens == 40
+    assert context.report['shifts'] == 0
+
+
+def test_shift_goes_on_past_the_context(stub_backend, stub_model):
+    stub_backend.tokens = 1000
+    llm = stub_model(n_ctx=64).llm
+    context = ContextWindow(llm, 'shift')
+    pieces, finish_reason = generate(context, 150)
+
+    assert finish_reason == 'length'
+    assert context.report['shifts'] >= 2
+    assert len(pieces) == context.completion_tokens == 150
+
+    # the kv cache holds the prompt and the latest answer tokens, the last one is not evaluated
+    tokens = stub_backend.get_tokens(llm)
+    n_prompt = context.report['prompt_tokens']
+    assert tokens[:n_prompt] == llm.tokenize('<|user|>\nhi\n<|assistant|>\n'.encode('utf-8'))
+    assert ''.join(pieces[:-1]).encode('utf-8').endswith(stub_backend.detokenize(llm, tokens[n_prompt:]))
+
+
+def test_shift_complete_counts_tokens(stub_backend, stub_model):
+    stub_backend.tokens = 30
+    context = ContextWindow(stub_model(n_ctx=512).llm, 'shift')
+    completion = context.complete([{'role': 'user', 'content': 'hi'}], 100, seed=1)
+    assert completion['choices'][0]['finish_reason'] == 'stop'
+    # the end of generation step is not counted
+    assert completion['usage']['completion_tokens'] == 30
+    assert completion['usage']['prompt_tokens'] == context.report['prompt_tokens'] > 0
+
+
+def test_truncate_keeps_system_only_prompt(stub_model):
+    context = ContextWindow(stub_model(n_ctx=128).llm, 'truncate')
+    messages = [{'role': 'system', 'content': 'lorem' + ' lorem' * 100}, {'role': 'system', 'content': 'be brief'}]
+    assert context.fit(messages, 32) == messages
+    assert context.report['dropped_messages'] == 0
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import vkllama_serve
+
+
+SCHEMA = {'type': 'object', 'properties': {'color': {'type': 'string'}, 'size': {'type': 'integer'}}}
+
+
+@pytest.fixture
+def compiled(server, stub_backend, monkeypatch):
+    # formats the backend was asked to compile
+    calls = []
+    compile_grammar = stub_backend.compile_grammar
+    def record(gbnf=None, schema=None):
+        calls.append(schema or gbnf or 'json')
+        return compile_grammar(gbnf=gbnf, schema=schema)
+    monkeypatch.setattr(stub_backend, 'compile_grammar', record)
+    return calls
+
+
+def generate(server, response_format, stream=False):
+    status, headers, data = server.post('/api/generate', {
+        'model': 'q:latest', 'prompt': 'a shirt', 'format': response_format, 'stream': stream, 'options': {'num_predict': 4}
+    })
+    assert status == 200
+    return [json.loads(line) for line in data.splitlines() if line][-1]
+
+
+def test_schema_compiled_once(server, compiled):
+    first = generate(server, SCHEMA)
+    assert not first['grammar_cache_hit']
+    assert first['grammar_cache_hit_rate'] == 0.0
+
+    # the same schema with another key order is the same grammar
+    reordered = dict(reversed(list(SCHEMA.items())))
+    second = generate(server, reordered, stream=True)
+    assert second['grammar_cache_hit']
+    assert second['grammar_compile_duration'] == 0
+    assert second['grammar_cache_hit_rate'] == 0.5
+    assert len(compiled) == 1
+
+    generate(server, 'json')
+    assert compiled[1] == 'json'
+
+
+def test_cache_evicts_least_recently_used(server, compiled, monkeypatch):
+    monkeypatch.setattr(vkllama_serve, 'GRAMMAR_CACHE_SIZE', 2)
+    schemas = [{'type': 'string', 'maxLength': n} for n in range(3)]
+
+    generate(server, schemas[0])
+    generate(server, schemas[1])
+    assert generate(server, schemas[0])['grammar_cache_hit']
+    generate(server, schemas[2])
+
+    # schemas[1] was the least recently used one
+    assert generate(server, schemas[0])['grammar_cache_hit']
+    assert not generate(server, schemas[1])['grammar_cache_hit']
+    assert len(compiled) == 4
+
+
+def test_no_format_no_metrics(server, compiled):
+    assert 'grammar_cache_hit' not in generate(server, None)
+    assert compiled == []
+
+
+def test_invalid_format(server, compiled):
+    status, headers, data = server.post('/api/generate', {'model': 'q:latest', 'prompt': 'hi', 'format': 'xml', 'stream': False})
+    assert status == 400
+    assert b'"format"' in data
+    assert compiled == []
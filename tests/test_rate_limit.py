@@ -0,0 +1,150 @@
+import pytest
+
+import vkllama_serve
+from vkllama_serve import RateLimiter, TokenBucket
+
+
+def make_limiter(rps=0, tpm=0):
+    limiter = RateLimiter()
+    limiter.default_limits = {'requests_per_second': rps, 'tokens_per_minute': tpm}
+    return limiter
+
+
+def available(limiter, client='a'):
+    return limiter.report(client)[0]['available']
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(10.0, 100.0)
+    bucket.level = 0.0
+    bucket.refill(bucket.updated + 2.0)
+    assert bucket.level == 20.0
+    assert bucket.wait_time(50.0) == pytest.approx(3.0)
+
+    bucket.refill(bucket.updated + 60.0)
+    assert bucket.level == 100.0
+    assert bucket.wait_time(50.0) == 0.0
+
+
+def test_unlimited_by_default():
+    limiter = make_limiter()
+    for _ in range(100):
+        assert limiter.admit('a', 'm', {}, 10**6) is None
+    assert available(limiter) == {}
+
+
+def test_requests_per_second():
+    limiter = make_limiter(rps=2)
+    assert limiter.admit('a', 'm', {}, 0) is None
+    assert limiter.admit('a', 'm', {}, 0) is None
+
+    wait, kind = limiter.admit('a', 'm', {}, 0)
+    assert kind == 'requests'
+    assert 0.0 < wait <= 0.5
+
+    # other clients and models have their own buckets
+    assert limiter.admit('b', 'm', {}, 0) is None
+    assert limiter.admit('a', 'n', {}, 0) is None
+    assert limiter.report('a')[0]['rejected'] == 1
+
+
+def test_tokens_are_reserved_and_refunded():
+    limiter = make_limiter(tpm=600)
+    assert limiter.admit('a', 'm', {}, 500) is None
+    assert available(limiter)['tokens'] == pytest.approx(100, abs=1)
+
+    # the reservation doesn't fit
+    wait, kind = limiter.admit('a', 'm', {}, 200)
+    assert kind == 'tokens'
+    assert wait == pytest.approx(10.0, abs=0.2)
+
+    # 120 of 500 used
+    limiter.charge('a', 'm', 500, 20, 100)
+    assert available(limiter)['tokens'] == pytest.approx(480, abs=1)
+    assert limiter.admit('a', 'm', {}, 200) is None
+
+    usage = limiter.report('a')[0]
+    assert (usage['requests'], usage['rejected'], usage['prompt_tokens'], usage['eval_tokens']) == (2, 1, 20, 100)
+
+
+def test_large_reservation_needs_full_bucket():
+    limiter = make_limiter(tpm=600)
+    assert limiter.admit('a', 'm', {}, 4096) is None
+    assert available(limiter)['tokens'] < 0
+    assert limiter.admit('a', 'm', {}, 1)[1] == 'tokens'
+
+    # refund never goes above the capacity
+    limiter.charge('a', 'm', 4096, 0, 0)
+    assert available(limiter)['tokens'] == 600
+
+
+def test_usage_over_reservation_goes_below_zero():
+    limiter = make_limiter(tpm=600)
+    assert limiter.admit('a', 'm', {}, 100) is None
+    limiter.charge('a', 'm', 100, 500, 300)
+    assert available(limiter)['tokens'] == pytest.approx(-200, abs=1)
+    assert limiter.admit('a', 'm', {}, 1)[1] == 'tokens'
+
+
+def test_model_limits_override_defaults():
+    limiter = make_limiter(rps=100)
+    model_info = {'limits': {'requests_per_second': 1}}
+    assert limiter.admit('a', 'm', model_info, 0) is None
+    assert limiter.admit('a', 'm', model_info, 0)[1] == 'requests'
+
+    # changed limits apply to known clients
+    assert limiter.admit('a', 'm', {'limits': {'requests_per_second': 0}}, 0) is None
+    assert limiter.report('a')[0]['limits'] == {'requests_per_second': 0, 'tokens_per_minute': 0}
+
+
+def test_report_filters_by_client():
+    limiter = make_limiter()
+    limiter.admit('a', 'm', {}, 0)
+    limiter.admit('b', 'm', {}, 0)
+    assert [u['client'] for u in limiter.report('a')] == ['a']
+    assert sorted(u['client'] for u in limiter.report()) == ['a', 'b']
+
+
+def test_rejected_request_compiles_no_grammar(server, monkeypatch):
+    vkllama_serve.rate_limiter.default_limits = {'requests_per_second': 1, 'tokens_per_minute': 0}
+    calls = []
+    get_grammar = vkllama_serve.get_grammar
+    monkeypatch.setattr(vkllama_serve, 'get_grammar', lambda response_format: calls.append(response_format) or get_grammar(response_format))
+
+    body = {'model': 'q', 'prompt': 'hi', 'stream': False, 'format': {'type': 'object'}, 'options': {'num_predict': 4}}
+    assert server.post('/api/generate', body)[0] == 200
+    status, headers, _ = server.post('/api/generate', body)
+    assert status == 429
+    assert float(headers['Retry-After']) > 0
+    assert len(calls) == 1
+
+
+def test_reservation_over_http(server):
+    vkllama_serve.rate_limiter.default_limits = {'requests_per_second': 0, 'tokens_per_minute': 600}
+
+    # answer of the stub is 128 tokens at most, the rest of the reservation comes back
+    body = {'model': 'q', 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 400}}
+    assert server.post('/api/generate', body)[0] == 200
+    status, usage = server.json('GET', '/api/usage')
+    assert status == 200
+    assert usage['usage'][0]['eval_tokens'] == 128
+    assert usage['usage'][0]['available']['tokens'] == pytest.approx(600 - 128 - usage['usage'][0]['prompt_tokens'], abs=2)
+
+    # doesn't fit what is left, OpenAI routes answer in their format
+    status, error = server.json('POST', '/v1/completions', {'model': 'q', 'prompt': 'hi', 'max_tokens': 500})
+    assert status == 429
+    assert error['error']['code'] == 'rate_limit_exceeded'
+    assert error['error']['type'] == 'tokens'
+
+
+def test_usage_of_all_clients_for_local_callers(server):
+    vkllama_serve.rate_limiter.default_limits = {'requests_per_second': 10, 'tokens_per_minute': 0}
+    server.post('/api/generate', {'model': 'q', 'prompt': 'hi', 'stream': False}, headers={'X-API-Key': 'secret'})
+    server.post('/api/generate', {'model': 'q', 'prompt': 'hi', 'stream': False})
+
+    status, mine = server.json('GET', '/api/usage')
+    assert [u['client'] for u in mine['usage']] == ['127.0.0.1']
+    status, everyone = server.json('GET', '/api/usage?all=1')
+    assert status == 200
+    clients = sorted(u['client'] for u in everyone['usage'])
+    assert clients[0] == '127.0.0.1' and clients[1].startswith('key:') and 'secret' not in clients[1]
@@ -0,0 +1,56 @@
+import json
+
+import vkllama_serve
+from conftest import STUB_MODELS
+
+
+def tags(server):
+    status, payload = server.json('GET', '/api/tags')
+    assert status == 200
+    return sorted(model['name'] for model in payload['models'])
+
+
+def write_models(models, config):
+    (models / 'models.json').write_text(json.dumps(config))
+
+
+def test_reload_on_change(server, models):
+    assert tags(server) == ['q:latest', 's:latest']
+
+    write_models(models, STUB_MODELS + [{'name': 'n:latest', 'filename': 'n.gguf'}])
+    assert tags(server) == ['n:latest', 'q:latest', 's:latest']
+    status, headers, data = server.post('/api/generate', {'model': 'n', 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 2}})
+    assert status == 200
+
+
+def test_broken_file_keeps_the_models(server, models):
+    assert tags(server) == ['q:latest', 's:latest']
+
+    (models / 'models.json').write_text('[{"name": ')
+    assert tags(server) == ['q:latest', 's:latest']
+
+    write_models(models, STUB_MODELS[:1])
+    assert tags(server) == ['s:latest']
+
+
+def test_changed_model_is_unloaded(server, models):
+    status, headers, data = server.post('/api/generate', {'model': 'q', 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 2}})
+    assert status == 200
+    assert [model['name'] for model in server.json('GET', '/api/ps')[1]['models']] == ['q:latest']
+
+    # the idle instance of the old entry is retired with the reload
+    write_models(models, [STUB_MODELS[0], dict(STUB_MODELS[1], thinking=True)])
+    tags(server)
+    assert server.json('GET', '/api/ps')[1]['models'] == []
+
+
+def test_sighup_reloads_an_unchanged_stamp(server, models):
+    assert tags(server) == ['q:latest', 's:latest']
+
+    # same size and time as far as the stamp goes
+    write_models(models, list(reversed(STUB_MODELS)))
+    vkllama_serve.models_stamp = vkllama_serve.get_models_stamp()
+    assert [model['name'] for model in vkllama_serve.get_models()] == ['s:latest', 'q:latest']
+
+    vkllama_serve.reload_models()
+    assert [model['name'] for model in vkllama_serve.get_models()] == ['q:latest', 's:latest']
@@ -0,0 +1,159 @@
+import threading
+import time
+
+from vkllama_serve import Scheduler
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_free_slot_goes_to_higher_priority():
+    scheduler = Scheduler(slots=1)
+    running = scheduler.acquire('normal')
+    tickets = {}
+
+    def acquire(priority):
+        tickets[priority] = scheduler.acquire(priority)
+
+    low = start(acquire, 'low')
+    wait_for(lambda: scheduler.waiting['low'])
+    high = start(acquire, 'high')
+    wait_for(lambda: scheduler.waiting['high'])
+
+    scheduler.release(running)
+    high.join(5)
+    assert tickets['high'].granted
+    assert 'low' not in tickets
+
+    scheduler.release(tickets['high'])
+    low.join(5)
+    assert tickets['low'].granted
+    scheduler.release(tickets['low'])
+    assert scheduler.running == 0
+
+
+def test_idle_class_starts_at_virtual_clock():
+    scheduler = Scheduler(slots=1)
+    high = scheduler.acquire('high')
+    for _ in range(800):
+        scheduler.yield_point(high)
+    scheduler.release(high)
+
+    # 800 tokens at weight 8, low doesn't get the credit of the idle time
+    low = scheduler.acquire('low')
+    assert scheduler.virtual_time['low'] == scheduler.virtual_time['high'] == 100.0
+    scheduler.release(low)
+
+
+def test_high_preempts_low_after_long_high_run():
+    # a long high generation, then a low one, then a short high one: the second high
+    # request must not wait for the low one because of the high class virtual time
+    scheduler = Scheduler(slots=1)
+    high = scheduler.acquire('high')
+    for _ in range(2000):
+        scheduler.yield_point(high)
+    scheduler.release(high)
+
+    stop = threading.Event()
+    tickets = {}
+
+    def generate_low():
+        ticket = tickets['low'] = scheduler.acquire('low')
+        while not stop.is_set():
+            scheduler.yield_point(ticket)
+            time.sleep(0.001)
+        scheduler.release(ticket)
+
+    low = start(generate_low)
+    wait_for(lambda: 'low' in tickets)
+
+    def acquire_high():
+        tickets['high'] = scheduler.acquire('high')
+
+    start(acquire_high).join(1.0)
+    try:
+        assert 'high' in tickets, 'high request waits for the low one'
+    finally:
+        stop.set()
+    assert not tickets['low'].granted
+    high = tickets['high']
+
+    for _ in range(5):
+        scheduler.yield_point(high)
+    scheduler.release(high)
+
+    low.join(5)
+
+    assert tickets['low'].preemptions == 1
+    assert high.preemptions == 0
+    metrics = scheduler.get_metrics()
+    assert metrics['running'] == 0
+    assert metrics['classes']['low']['preemptions'] == 1
+
+
+def test_no_preemption_without_waiting_higher_class():
+    scheduler = Scheduler(slots=1)
+    low = scheduler.acquire('low')
+    paused = []
+    low.on_pause = lambda: paused.append(True)
+    for _ in range(100):
+        scheduler.yield_point(low)
+    scheduler.release(low)
+    assert not paused
+    assert low.preemptions == 0
+
+
+def test_paused_ticket_lends_its_model():
+    scheduler = Scheduler(slots=1)
+    events = []
+    tickets = {}
+    stop = threading.Event()
+
+    def pause():
+        events.append('pause')
+        return lambda: events.append('resume')
+
+    def generate_low():
+        ticket = tickets['low'] = scheduler.acquire('low')
+        ticket.on_pause = pause
+        while not stop.is_set():
+            scheduler.yield_point(ticket)
+            time.sleep(0.001)
+        scheduler.release(ticket)
+
+    low = start(generate_low)
+    wait_for(lambda: 'low' in tickets and tickets['low'].on_pause)
+
+    high = scheduler.acquire('high')
+    assert events == ['pause']
+    scheduler.release(high)
+
+    wait_for(lambda: events == ['pause', 'resume'])
+    stop.set()
+    low.join(5)
+
+
+def test_generated_excludes_end_of_generation_step():
+    scheduler = Scheduler(slots=1)
+    ticket = scheduler.acquire('normal')
+    hook = scheduler.token_hook(ticket)
+    for _ in range(21):
+        hook(None, None)
+    ticket.end_generation('stop')
+    for _ in range(10):
+        hook(None, None)
+    ticket.end_generation('length')
+    scheduler.release(ticket)
+
+    assert ticket.tokens == 31
+    assert ticket.generated == 30
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from vkllama_serve import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path / 'sessions'))
+
+
+def evaluate(backend, model, text):
+    tokens = model.llm.tokenize(text.encode('utf-8'))
+    backend.evaluate(model.llm, tokens)
+    return tokens
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma', 'none'])
+def test_save_load_round_trip(stub_backend, stub_model, store, compression):
+    store.compression = compression
+    model = stub_model(n_ctx=256)
+    tokens = evaluate(stub_backend, model, 'system be brief user hi assistant lorem ipsum')
+
+    header = store.save('chat-1', model, tokens)
+    assert header['compression'] == compression
+    assert header['n_tokens'] == len(tokens)
+    assert header['size'] > 0
+
+    # a fresh instance gets the snapshot through the next request of the session
+    restored = SessionStore(store.path, compression)
+    loaded = restored.load('chat-1')
+    assert (loaded['model'], loaded['n_ctx'], loaded['fingerprint']) == ('stub:latest', 256, 'stub')
+    assert restored.get('chat-1')['tokens'] == tokens
+
+    other = stub_model(n_ctx=256, seed=8)
+    state = restored.take_state('chat-1', other)
+    stub_backend.load_state(other.llm, state)
+    assert stub_backend.get_tokens(other.llm) == tokens
+
+    # taken once
+    assert restored.take_state('chat-1', other) is None
+
+
+def test_save_evaluates_a_reused_instance_again(stub_backend, stub_model, store):
+    model = stub_model()
+    tokens = evaluate(stub_backend, model, 'user hi')
+
+    # another request used the instance since
+    stub_backend.reset(model.llm)
+    evaluate(stub_backend, model, 'user something else')
+
+    assert store.save('chat-1', model, tokens)['n_tokens'] == len(tokens)
+    store.load('chat-1')
+    assert stub_backend.get_state_tokens(store.take_state('chat-1', model)) == tokens
+
+
+@pytest.mark.parametrize('model_info', [{'n_ctx': 512}, {'digest': 'other'}])
+def test_snapshot_of_another_model_is_not_restored(stub_backend, stub_model, store, model_info):
+    model = stub_model(n_ctx=256)
+    store.save('chat-1', model, evaluate(stub_backend, model, 'user hi'))
+    store.load('chat-1')
+    assert store.take_state('chat-1', stub_model(**dict({'n_ctx': 256}, **model_info))) is None
+
+
+def test_update_and_discard(stub_backend, stub_model, store):
+    model = stub_model()
+    tokens = evaluate(stub_backend, model, 'user hi')
+    store.update('chat-1', model)
+    assert store.get('chat-1')['tokens'] == tokens
+
+    store.save('chat-1', model, tokens)
+
+    # the snapshot file is kept, e.g. when a load asked for another model
+    store.discard('chat-1', remove_file=False)
+    assert store.get('chat-1') is None
+    assert os.path.exists(store.get_filename('chat-1'))
+
+    store.discard('chat-1')
+    assert not os.path.exists(store.get_filename('chat-1'))
+
+
+def test_load_rejects_other_files(store):
+    with open(store.get_filename('chat-1'), 'wb') as f:
+        f.write(b'not a snapshot')
+    with pytest.raises(ValueError):
+        store.load('chat-1')
+
+
+def test_state_is_sized_by_the_tokens_not_the_context(stub_backend, stub_model):
+    model = stub_model(n_ctx=4096)
+    tokens = evaluate(stub_backend, model, 'user hi')
+
+    state = stub_backend.save_state(model.llm)
+    assert len(state.input_ids) == len(tokens)
+    assert state.scores.shape[0] == 1
+
+    fields, payload = stub_backend.dump_state(state)
+    restored = stub_backend.restore_state(dict(fields, n_ctx=4096), payload)
+    assert stub_backend.get_state_tokens(restored) == tokens
+
+    # an empty context has no logits row
+    stub_backend.reset(model.llm)
+    empty = stub_backend.save_state(model.llm)
+    assert empty.scores.shape[0] == 0
+    fields, payload = stub_backend.dump_state(empty)
+    assert stub_backend.get_state_tokens(stub_backend.restore_state(fields, payload)) == []
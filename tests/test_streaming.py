@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+
+OPTIONS = {'num_predict': 12, 'seed': 3}
+CHAT = [{'role': 'user', 'content': 'hi'}]
+
+
+def read_events(data):
+    # every server-sent event is one "data: ..." line and a blank line
+    assert data.endswith(b'\n\n')
+    events = data[:-2].split(b'\n\n')
+    assert all(event.startswith(b'data: ') and b'\n' not in event for event in events)
+    return [event[len(b'data: '):] for event in events]
+
+
+def test_openai_stream_framing_and_usage(server):
+    body = {'model': 'q:latest', 'messages': CHAT, 'seed': 3, 'max_tokens': 12}
+    status, headers, data = server.post('/v1/chat/completions', dict(body, stream=True, stream_options={'include_usage': True}))
+    assert status == 200
+    assert headers['Content-type'] == 'text/event-stream'
+
+    events = read_events(data)
+    assert events[-1] == b'[DONE]'
+    chunks = [json.loads(event) for event in events[:-1]]
+    assert len({chunk['id'] for chunk in chunks}) == 1
+
+    # the usage chunk comes last and has no choices
+    usage_chunk = chunks[-1]
+    assert usage_chunk['choices'] == []
+    assert all('usage' not in chunk for chunk in chunks[:-1])
+    content = ''.join(chunk['choices'][0]['delta'].get('content', '') for chunk in chunks[:-1])
+    assert [chunk['choices'][0]['finish_reason'] for chunk in chunks[:-1]].count(None) == len(chunks) - 2
+
+    status, whole = server.json('POST', '/v1/chat/completions', body)
+    assert status == 200
+    assert content == whole['choices'][0]['message']['content']
+    assert usage_chunk['usage'] == whole['usage']
+
+
+def test_openai_stream_without_usage(server):
+    status, headers, data = server.post('/v1/chat/completions', {'model': 'q:latest', 'messages': CHAT, 'max_tokens': 4, 'stream': True})
+    assert status == 200
+    events = read_events(data)
+    assert events[-1] == b'[DONE]'
+    assert all('usage' not in json.loads(event) for event in events[:-1])
+
+
+def ndjson(data):
+    return [json.loads(line) for line in data.splitlines() if line]
+
+
+@pytest.mark.parametrize('route, body', [
+    ('/api/generate', {'prompt': 'hi'}),
+    ('/api/chat', {'messages': CHAT})
+])
+def test_ollama_final_chunk_counts(server, route, body):
+    body = dict(body, model='q:latest', options=OPTIONS)
+    status, headers, data = server.post(route, dict(body, stream=True))
+    assert status == 200
+    final = ndjson(data)[-1]
+    assert final['done']
+
+    status, whole = server.json('POST', route, dict(body, stream=False))
+    assert status == 200
+    assert final['prompt_eval_count'] == whole['prompt_eval_count'] > 0
+    assert final['eval_count'] == whole['eval_count'] > 0
+
+
+def test_ollama_candidates_counts(server):
+    body = {'model': 'q:latest', 'prompt': 'hi', 'options': OPTIONS, 'n': 2}
+    status, headers, data = server.post('/api/generate', dict(body, stream=True))
+    finals = [chunk for chunk in ndjson(data) if 'done_reason' in chunk]
+    assert [chunk['candidate'] for chunk in finals] == [0, 1]
+
+    status, whole = server.json('POST', '/api/generate', dict(body, stream=False))
+    # the done chunk has the totals of the request, like the whole response
+    assert finals[-1]['eval_count'] == whole['eval_count']
+    assert 0 < finals[0]['eval_count'] < finals[-1]['eval_count']
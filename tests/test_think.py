@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from vkllama_serve import ThinkControl, ThinkPrompt, ThinkSplitter, find_last, split_thinking
+
+
+def feed_all(splitter, chunks):
+    think, answer = '', ''
+    for chunk in chunks:
+        t, a = splitter.feed(chunk)
+        think += t
+        answer += a
+    t, a = splitter.flush()
+    return think + t, answer + a
+
+
+@pytest.mark.parametrize('chunks', [
+    ['<think>', 'plan', '</think>', 'answer'],
+    ['<think>plan</think>answer'],
+    ['<thi', 'nk>pl', 'an</th', 'ink>ans', 'wer'],
+    ['<', 't', 'h', 'i', 'n', 'k', '>', 'plan', '<', '/', 'think', '>', 'answer'],
+    ['<think>\n', 'plan\n', '</think>\n\n', 'answer']
+])
+def test_splitter_tags_across_chunks(chunks):
+    think, answer = feed_all(ThinkSplitter(), chunks)
+    assert think.strip() == 'plan'
+    assert answer == 'answer'
+
+
+def test_splitter_holds_back_possible_tag_only():
+    splitter = ThinkSplitter(thinking=False)
+    assert splitter.feed('a < b') == ('', 'a < b')
+    assert splitter.feed(' and <') == ('', ' and ')
+    assert splitter.feed('b>') == ('', '<b>')
+
+
+def test_splitter_without_think_block():
+    assert feed_all(ThinkSplitter(thinking=False), ['just ', 'an ', 'answer']) == ('', 'just an answer')
+
+
+def test_splitter_template_opened_think_block():
+    # the chat template opened the block, the model only closes it
+    assert feed_all(ThinkSplitter(thinking=True), ['plan', '</think>', 'answer']) == ('plan', 'answer')
+
+
+@pytest.mark.parametrize('prompt, chunks', [
+    ('user hi', ['plain', ' answer']),
+    ('user hi', ['<think>plan</think>', 'answer']),
+    ('user hi <think>\n', ['plan</think>', 'answer']),
+    ('user hi <think>', ['unfinished plan']),
+    ('user hi <think></think>', ['plain', ' answer'])
+])
+def test_stream_and_whole_answer_split_alike(stub_model, prompt, chunks):
+    # the stream starts in the think block only when the prompt left it open
+    llm = stub_model(thinking=True).llm
+    think_prompt = ThinkPrompt(llm)
+    splitter = ThinkSplitter(prompt=think_prompt)
+    think_prompt(np.array(llm.tokenize(prompt.encode('utf-8'))), None)
+
+    think, answer = feed_all(splitter, chunks)
+    assert split_thinking(''.join(chunks), think_prompt.open) == (think.strip() or None, answer.strip())
+    if not think_prompt.open and not chunks[0].startswith('<think>'):
+        assert (think, answer) == ('', ''.join(chunks))
+
+
+def test_split_thinking():
+    assert split_thinking('<think>\nplan\n</think>\n\nanswer') == ('plan', 'answer')
+    assert split_thinking('<think></think>answer') == (None, 'answer')
+    assert split_thinking(' answer ') == (None, 'answer')
+
+
+def test_find_last():
+    assert find_last([1, 2, 3, 1, 2], [1, 2]) == 3
+    assert find_last([1, 2, 3], [3]) == 2
+    assert find_last([1, 2, 3], [4]) == -1
+    assert find_last([1], [1, 2]) == -1
+
+
+def run_think_control(llm, control, prompt, answer):
+    # samples `answer` token by token, forced tokens are inserted before the next answer token
+    input_ids = llm.tokenize(prompt.encode('utf-8'))
+    answer_ids = llm.tokenize(answer.encode('utf-8'), add_bos=False)
+    sampled = []
+    while answer_ids:
+        scores = control(np.array(input_ids), np.zeros(llm.n_vocab(), dtype=np.single))
+        forced = np.flatnonzero(scores == 0.0)
+        token = int(forced[0]) if len(forced) == 1 else answer_ids.pop(0)
+        sampled.append(token)
+        input_ids.append(token)
+    return llm.detokenize(sampled).decode('utf-8')
+
+
+@pytest.mark.parametrize('prompt, expected', [
+    ('user hi', '<think>\n\n</think>\n\n lorem ipsum'),
+    # the chat template opened the block, with or without a newline after the tag
+    ('user hi <think>', '</think>\n\n lorem ipsum'),
+    ('user hi <think>\n', '</think>\n\n lorem ipsum')
+])
+def test_think_control_disables_thinking(stub_model, prompt, expected):
+    llm = stub_model(thinking=True).llm
+    answer = run_think_control(llm, ThinkControl(llm, False, None), prompt, ' lorem ipsum')
+    assert answer == expected
+
+
+def test_think_control_budget(stub_model):
+    llm = stub_model(thinking=True).llm
+    control = ThinkControl(llm, None, 2)
+    answer = run_think_control(llm, control, 'user hi', '<think> lorem ipsum dolor sit amet')
+    assert answer == '<think> lorem ipsum\n\n</think>\n\n dolor sit amet'
+
+    # the next candidate gets the whole budget again
+    control.reset()
+    answer = run_think_control(llm, control, 'user hi', '<think> lorem</think> ipsum')
+    assert answer == '<think> lorem</think> ipsum'
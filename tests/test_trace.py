@@ -0,0 +1,41 @@
+import collections
+import json
+
+import vkllama_serve
+
+
+def test_profile_local(server):
+    status, headers, data = server.get('/api/debug/profile?seconds=0.1&interval=0.01')
+    assert status == 200
+    assert int(headers['X-Profile-Samples']) > 0
+    # folded stacks: "thread;frame;frame count"
+    for line in data.decode('utf-8').splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+
+
+def test_profile_duration_capped(server, monkeypatch):
+    calls = []
+    monkeypatch.setattr(vkllama_serve, 'sample_profile', lambda seconds, interval: calls.append(seconds) or (collections.Counter(), 0))
+    status, headers, data = server.get('/api/debug/profile?seconds=3600')
+    assert status == 200
+    assert calls == [vkllama_serve.MAX_PROFILE_SECONDS]
+
+
+def test_profile_forbidden_for_remote(server, monkeypatch):
+    monkeypatch.setattr(vkllama_serve.VKLlamaRequestHandler, 'is_local', lambda self: False)
+    status, headers, data = server.get('/api/debug/profile?seconds=0.1')
+    assert status == 403
+
+
+def test_sampled_trace_is_exported(server, monkeypatch, tmp_path):
+    path = tmp_path / 'trace.json'
+    monkeypatch.setattr(vkllama_serve.tracer, 'path', str(path))
+    monkeypatch.setattr(vkllama_serve.tracer, 'sample_rate', 1.0)
+    status, headers, data = server.post('/api/generate', {'model': 'q:latest', 'prompt': 'hi', 'stream': False, 'options': {'num_predict': 4}})
+    assert status == 200
+
+    # chrome trace viewers accept the array without the closing bracket
+    events = json.loads(path.read_text().rstrip().rstrip(',') + ']')
+    assert events
+    assert {event['args']['request_id'] for event in events} == {headers['X-Request-Id']}